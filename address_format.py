@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This module formats the generated interface addresses the way each NOS
+  expects them in its configuration, selected per platform with the
+  address_format key of platform_definitions.yaml:
+
+- cidr: addresses as generated, e.g. 192.0.2.0/31 and 2001:db8::/127
+- mask: IPv4 with a dotted subnet mask, e.g. 192.0.2.0 255.255.255.254
+  (IOS, IOS-XE)
+- freertr: IPv4 with a dotted subnet mask and a space between the IPv6
+  address and its prefix length, e.g. 2001:db8:: /127
+
+IPv4 masks come from a table computed once for all prefix lengths. The
+  formatted interfaces are new records, the interface table is never
+  modified, so rendering can run again or in parallel on the same table.
+"""
+
+
+def dotted_mask(prefix):
+    # 24 -> "255.255.255.0"
+    mask = (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+    return ".".join(str(mask >> shift & 0xFF) for shift in (24, 16, 8, 0))
+
+
+# Dotted subnet mask of every IPv4 prefix length
+MASKS = [dotted_mask(prefix) for prefix in range(33)]
+
+
+def split_address(address, length):
+    # "192.0.2.1/31" -> ("192.0.2.1", 31), the full length without prefix
+    address, _, prefix = address.partition("/")
+    return address, int(prefix) if prefix else length
+
+
+def ipv4_mask(address):
+    address, prefix = split_address(address, 32)
+    return f"{address} {MASKS[prefix]}"
+
+
+def ipv6_spaced(address):
+    address, prefix = split_address(address, 128)
+    return f"{address} /{prefix}"
+
+
+def unchanged(address):
+    return address
+
+
+# Format name: (IPv4 formatter, IPv6 formatter)
+FORMATS = {
+    "cidr": (unchanged, unchanged),
+    "mask": (ipv4_mask, unchanged),
+    "freertr": (ipv4_mask, ipv6_spaced),
+}
+
+
+def default_format(platform):
+    # Platforms without an address_format keep the format the templates
+    #  always received, which was selected on the platform name
+    if "freertr" in platform:
+        return "freertr"
+    if "ios" in platform:
+        return "mask"
+    return "cidr"
+
+
+def platform_format(platforms, platform):
+    # Validated platforms always have address_format, others fall back to
+    #  the name based default
+    return (platforms.get(platform, {}).get("address_format")
+            or default_format(platform))
+
+
+def format_interfaces(records, address_format):
+    # New interface records with the addresses in the given format
+    ipv4_format, ipv6_format = FORMATS[address_format]
+    if ipv4_format is unchanged and ipv6_format is unchanged:
+        return list(records)
+
+    formatted = []
+    for record in records:
+        formatted.append(record._replace(
+            ipv4=ipv4_format(record.ipv4) if record.ipv4 else record.ipv4,
+            ipv6=ipv6_format(record.ipv6) if record.ipv6 else record.ipv6))
+    return formatted
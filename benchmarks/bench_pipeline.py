@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This script benchmarks the offline pipeline stages (validate, plan, IP
+  allocation, render) and the full offline pipeline over synthetic labs
+  from 10 to 10k links. Nothing is deployed, no ESXi host is needed.
+
+For every lab size and stage it records:
+- Wall time: best of --repeat runs (without tracing, which slows Python)
+- Peak memory: highest traced memory during one run (tracemalloc)
+- Allocations: memory blocks allocated during that run and still alive at
+  its end, which also counts the blocks of the returned result
+
+Results can be saved as a baseline and later runs compared with it. Any
+  stage slower (by at least 2 ms) or using more peak memory than the
+  baseline by more than the threshold is reported as a regression and the
+  script exits with status 1, so it can gate changes.
+
+Usage:
+  python benchmarks/bench_pipeline.py --save-baseline baseline.json
+  python benchmarks/bench_pipeline.py --baseline baseline.json -th 0.25
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import build_cache  # noqa: E402
+import config_render  # noqa: E402
+import esxi_create  # noqa: E402
+import ip_generate  # noqa: E402
+import lab_state  # noqa: E402
+import topology_gen  # noqa: E402
+import validate_nodes  # noqa: E402
+
+# Lab sizes in links, the nodes are capped at the 254 node limit
+SIZES = [10, 100, 1000, 10000]
+
+STAGES = ["validate", "plan", "ip_allocate", "render", "pipeline"]
+
+TEMPLATE = "3xSP-Lab1-base-config.j2"
+
+# Synthetic platform with enough interfaces for 10k links over 254 nodes.
+#  The name contains "ios" so the template takes the same path as the IOS
+#  platforms, and addresses use the IOS mask format.
+PLATFORM = "iosbench"
+PLATFORM_INTERFACES = 128
+
+# Time differences below this many seconds are noise, never a regression
+TIME_FLOOR = 0.002
+
+
+def synthetic_platforms():
+    return {
+        PLATFORM: {
+            "folder": "BENCH",
+            "base_tport": 10000,
+            "clone": "thin",
+            "address_format": "mask",
+            "interfaces": {str(i): f"g{i}"
+                           for i in range(PLATFORM_INTERFACES)},
+        }
+    }
+
+
+def synthetic_lab(links, platforms):
+    nodes = min(links, topology_gen.MAX_NODES)
+    return topology_gen.generate("random", platforms, nodes=nodes,
+                                 links=links, platform=PLATFORM, seed=links,
+                                 options={"lab_name": f"bench{links}"})
+
+
+def isolate(workdir):
+    # Keep the benchmark away from the real VLAN leases and build cache.
+    #  ESXi has 4085 usable VLANs per vSwitch, the range is widened here so
+    #  the plan stage can be measured at 10k links.
+    lab_state.STATE_FILE = os.path.join(workdir, "state.db")
+    lab_state.VLAN_MAX = 1000000
+    build_cache.CACHE_DIR = os.path.join(workdir, "cache")
+    build_cache.enabled = False
+
+
+def reset_state():
+    # IP assignments are sticky, so every measured IP allocation starts
+    #  from an empty state database, like the first run of the lab
+    if os.path.exists(lab_state.STATE_FILE):
+        os.remove(lab_state.STATE_FILE)
+
+
+# Each stage is (setup, run): setup prepares fresh inputs outside of the
+#  measurement, run is the measured stage
+def stage_functions(lab, platforms):
+
+    def plan():
+        return esxi_create.esxi_create(lab=lab, platforms=platforms,
+                                       output=False, deploy=False,
+                                       lease=False)
+
+    def ip_allocate(esxi):
+        # Stored like a configuration run does, the change report is not
+        #  part of the measurement and is dropped
+        interfaces, changes = ip_generate.lab_ip_gen(
+            lab=lab, platforms=platforms,
+            esxi_interfaces=esxi["neighbor_interfaces"], output=False,
+            store=True)
+        return interfaces
+
+    def render(interfaces):
+        return config_render.render(lab=lab, platforms=platforms,
+                                    interfaces=interfaces,
+                                    j2_file=TEMPLATE, output=False,
+                                    jobs=1)
+
+    def pipeline():
+        validate_nodes.validate_lab(lab, platforms)
+        return render(ip_allocate(plan()))
+
+    def ip_setup():
+        reset_state()
+        return (esxi,)
+
+    def pipeline_setup():
+        reset_state()
+        return ()
+
+    esxi = plan()
+    interfaces = ip_allocate(esxi)
+
+    return {
+        "validate": (lambda: (), lambda: validate_nodes.validate_lab(
+            lab, platforms)),
+        "plan": (lambda: (), plan),
+        "ip_allocate": (ip_setup, ip_allocate),
+        "render": (lambda: (interfaces,), render),
+        "pipeline": (pipeline_setup, pipeline),
+    }
+
+
+def measure(setup, run, repeat):
+    best = None
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        run(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    args = setup()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    result = run(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    allocations = sys.getallocatedblocks() - blocks
+    del result
+
+    return {"time": best, "peak": peak, "allocations": allocations}
+
+
+def run_benchmarks(sizes, repeat):
+    platforms = synthetic_platforms()
+    results = {}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        isolate(workdir)
+
+        for links in sizes:
+            lab = synthetic_lab(links, platforms)
+            functions = stage_functions(lab, platforms)
+
+            for stage in STAGES:
+                setup, run = functions[stage]
+                results[f"{stage}/{links}"] = measure(setup, run, repeat)
+
+    return results
+
+
+def print_results(results, baseline=None):
+    print(f'{"stage":<14}{"links":>7}{"time (ms)":>12}{"peak (KiB)":>12}'
+          f'{"allocs":>10}{"vs baseline":>14}')
+
+    for name, result in results.items():
+        stage, links = name.split("/")
+        line = (f'{stage:<14}{links:>7}{result["time"] * 1000:>12.2f}'
+                f'{result["peak"] / 1024:>12.1f}{result["allocations"]:>10}')
+        if baseline and name in baseline:
+            ratio = result["time"] / baseline[name]["time"]
+            line += f"{ratio:>13.2f}x"
+        print(line)
+
+
+def regressions(results, baseline, threshold):
+    # Stages slower or using more peak memory than allowed by the threshold
+    found = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ("time", "peak"):
+            limit = baseline[name][metric] * (1 + threshold)
+            if metric == "time":
+                limit = max(limit, baseline[name][metric] + TIME_FLOOR)
+            if result[metric] > limit:
+                change = result[metric] / baseline[name][metric] - 1
+                found.append(f"{name} {metric}: {change:+.0%} "
+                             f"(threshold {threshold:.0%})")
+    return found
+
+
+def main(options):
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+
+    save_baseline = options.save_baseline
+    if save_baseline:
+        save_baseline = os.path.abspath(save_baseline)
+
+    # The template is loaded relative to the repository, like esxi_netlab.py
+    os.chdir(REPO)
+
+    results = run_benchmarks(options.sizes, options.repeat)
+
+    print_results(results, baseline)
+
+    if save_baseline:
+        with open(save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nBaseline saved to \"{save_baseline}\"")
+
+    if baseline:
+        found = regressions(results, baseline, options.threshold)
+        if found:
+            print("\n===== Regressions =====")
+            for regression in found:
+                print(regression)
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the offline lab "
+                                                 "pipeline stages")
+
+    parser.add_argument("-s",
+                        "--sizes",
+                        action="store",
+                        type=int,
+                        nargs="+",
+                        default=SIZES,
+                        help="Lab sizes in links (default: 10 100 1000 "
+                             "10000)",
+                        metavar="LINKS",
+                        dest="sizes")
+
+    parser.add_argument("-r",
+                        "--repeat",
+                        action="store",
+                        type=int,
+                        default=3,
+                        help="Timed runs per stage, the best is kept",
+                        dest="repeat")
+
+    parser.add_argument("-b",
+                        "--baseline",
+                        action="store",
+                        type=str,
+                        help="Compare the results with this baseline file",
+                        metavar="baseline.json",
+                        dest="baseline")
+
+    parser.add_argument("-sb",
+                        "--save-baseline",
+                        action="store",
+                        type=str,
+                        help="Save the results as a baseline file",
+                        metavar="baseline.json",
+                        dest="save_baseline")
+
+    parser.add_argument("-th",
+                        "--threshold",
+                        action="store",
+                        type=float,
+                        default=0.20,
+                        help="Allowed increase over the baseline before a "
+                             "stage is a regression (default: 0.20 = 20%%)",
+                        dest="threshold")
+
+    args = parser.parse_args()
+
+    main(args)
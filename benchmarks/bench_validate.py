@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This script times validate_nodes.validate_lab on generated labs of growing
+  size to show that validation scales linearly with nodes + links.
+
+- Nodes series: every node has 4 neighbors, the node count doubles
+- Links series: 254 nodes, the number of neighbors per node doubles
+
+Node numbers above 254 are reported as errors by the validator, but every
+  other check still runs for those nodes, so the node series keeps the same
+  amount of work per node.
+
+Usage: python benchmarks/bench_validate.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import validate_nodes  # noqa: E402
+
+REPEAT = 3  # Best of REPEAT runs is reported
+
+
+def synthetic_platforms(interfaces):
+    return {
+        "bench": {
+            "folder": "Bench",
+            "base_tport": 2000,
+            "clone": "thin",
+            "interfaces": {i: f"eth{i}" for i in range(1, interfaces + 1)},
+        }
+    }
+
+
+def synthetic_lab(nodes, degree):
+    # Circulant graph: every node connects to the degree / 2 nodes on each
+    #  side of it, which keeps every neighbor list reciprocal
+    lab = {
+        "lab_options": {
+            "lab_name": "bench",
+            "term_serv": "esxi.example.com",
+            "esxi_username": "root",
+            "tport_base": 20,
+            "datastore": "bench",
+            "vswitch": "vSwitch1",
+            "pg_base": "Lab",
+        },
+        "nodes": {},
+    }
+
+    for node in range(1, nodes + 1):
+        neighbors = []
+        for step in range(1, degree // 2 + 1):
+            neighbors.append((node - 1 + step) % nodes + 1)
+            neighbors.append((node - 1 - step) % nodes + 1)
+        lab["nodes"][node] = {
+            "hostname": f"R{node}",
+            "platform": "bench",
+            "site": 1,
+            "neighbors": neighbors,
+        }
+
+    return lab
+
+
+def best_time(lab, platforms):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        validate_nodes.validate_lab(lab, platforms)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_series(title, sizes):
+    print(f"\n===== {title} =====")
+    print(f'{"nodes":>8}{"links":>10}{"time (ms)":>12}{"us per item":>14}')
+
+    for nodes, degree in sizes:
+        platforms = synthetic_platforms(degree)
+        lab = synthetic_lab(nodes, degree)
+        links = nodes * degree // 2
+
+        elapsed = best_time(lab, platforms)
+        per_item = elapsed / (nodes + links) * 1e6
+
+        print(f"{nodes:>8}{links:>10}{elapsed * 1000:>12.2f}"
+              f"{per_item:>14.3f}")
+
+
+if __name__ == "__main__":
+
+    run_series("Nodes (4 neighbors each)",
+               [(nodes, 4) for nodes in (250, 1000, 4000, 16000, 64000)])
+
+    run_series("Links (254 nodes)",
+               [(254, degree) for degree in (4, 16, 64, 128, 252)])
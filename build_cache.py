@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This module caches generated artifacts (the ESXi plan, the IP addressing
+  and every node configuration) and the validated platform and lab
+  definitions, keyed on a content hash of their inputs.
+
+- Each artifact is stored in its own file, holding the hash of the inputs
+  it was built from, so the cache never grows beyond one file per artifact
+- When the inputs hash to the same value, the stored artifact is reused
+- The hash includes the source code of the module building the artifact,
+  so code changes also cause a rebuild
+- Every artifact is recorded as rebuilt or reused for the final report
+"""
+import hashlib
+import inspect
+import json
+import os
+import pickle
+
+CACHE_DIR = ".netlab_cache"
+
+# Stored artifacts are only reused when enabled (disabled with --no-cache),
+#  rebuilt artifacts are always stored
+enabled = True
+
+# Artifact group: {"rebuilt": [names], "reused": [names]}
+_report = {}
+
+# Module name: hash of its source code
+_sources = {}
+
+
+def digest(*parts):
+    # Stable content hash of YAML-like data (dicts, lists, strings, numbers)
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def source_digest(module):
+    # Hash of the source code of the module building an artifact
+    if module.__name__ not in _sources:
+        _sources[module.__name__] = file_digest(inspect.getsourcefile(module))
+    return _sources[module.__name__]
+
+
+def cache_file(lab, artifact):
+    return os.path.join(CACHE_DIR, lab["lab_options"]["lab_name"],
+                        f"{artifact}.pickle")
+
+
+def definitions_file(yaml_file):
+    # Validated definitions are cached per YAML file, the hash of the full
+    #  path keeps files with the same name in different folders apart
+    path_hash = hashlib.sha256(os.path.abspath(yaml_file).encode()).hexdigest()
+    name = f"{os.path.basename(yaml_file)}-{path_hash[:12]}.pickle"
+    return os.path.join(CACHE_DIR, "definitions", name)
+
+
+def load(lab, artifact, key):
+    return load_path(cache_file(lab, artifact), key)
+
+
+def store(lab, artifact, key, value):
+    store_path(cache_file(lab, artifact), key, value)
+
+
+def load_path(path, key):
+    # Return the stored artifact if it was built from the same inputs
+    if not enabled:
+        return None
+
+    try:
+        with open(path, "rb") as f:
+            entry = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+    if entry["key"] != key:
+        return None
+    return entry["value"]
+
+
+def store_path(path, key, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write to a temporary file first so an interrupted run cannot leave a
+    #  truncated cache entry behind
+    with open(f"{path}.tmp", "wb") as f:
+        pickle.dump({"key": key, "value": value}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{path}.tmp", path)
+
+
+def record(group, name, rebuilt):
+    entry = _report.setdefault(group, {"rebuilt": [], "reused": []})
+    entry["rebuilt" if rebuilt else "reused"].append(name)
+
+
+def report():
+    # Print which artifacts were rebuilt and which came from the cache
+    if not _report:
+        return
+
+    print("\n===== Build cache =====")
+    for group, entry in _report.items():
+        total = len(entry["rebuilt"]) + len(entry["reused"])
+        print(f'{group}: {len(entry["rebuilt"])} of {total} rebuilt')
+        if 0 < len(entry["rebuilt"]) < total:
+            print(f'    rebuilt: {", ".join(map(str, entry["rebuilt"]))}')
@@ -2,149 +2,146 @@
 """
 Author: Jedadiah Casey, @Wax_Trax, neckercube.com
 - This module pushes the generated configurations to the lab nodes.
-- Make sure you lab nodes are fully-booted and ready to accept input!
+- Lab nodes are watched until they finish booting, every node is
+   configured as soon as it is ready to accept input
 - You have the option of configuring devices indvidually or simultaneously
-- This script currently works with IOS/XE and IOS-XR. You will need to
-   create additional platform stanzas to use other platforms.
+- Consoles are driven from one asyncio event loop, up to console_jobs
+   nodes (lab option, default 64) are configured at the same time and
+   every node reports its result
+- Every platform NOS is handled by a console driver (see
+   console_drivers.py) selected by the driver key of the platform
+   definitions. You will need to add a driver to use other platforms.
+- Every command waits for the device prompt (see console_session.py)
+   instead of sleeping, so fast devices are configured quickly and slow
+   ones are not overrun.
 """
+import asyncio
 import time
-from telnetlib import Telnet
-from threading import Thread
+from collections import namedtuple
+
+import console_drivers
+from console_session import ConsoleSession
+
+# Outcome of the push to one node: duration of the configuration and time
+#  until the node was ready in seconds (None without waiting), bytes sent
+#  and the last prompt or message seen on the console, error is None on
+#  success
+PushResult = namedtuple("PushResult", ["node", "success", "duration",
+                                       "ready", "sent", "last_prompt",
+                                       "error"])
+
+# Nodes configured at the same time unless the lab sets console_jobs
+CONSOLE_JOBS = 64
+
+
+def push_configs(lab, platforms, render, jobs=None, display=False,
+                 wait_ready=False):
+    # Push the rendered configurations to the lab nodes, configuring up to
+    #  "jobs" nodes at the same time, returning {node: PushResult}. With
+    #  wait_ready, every node is configured as soon as it finished booting.
+    jobs = jobs or lab["lab_options"].get("console_jobs", CONSOLE_JOBS)
+    results = asyncio.run(push_all(lab, platforms, render, jobs, display,
+                                   wait_ready))
+    return {result.node: result for result in results}
+
+
+class PushProgress:
+    # Overall progress view, one line per node booted or configured
+
+    def __init__(self, lab, total):
+        self.lab = lab
+        self.total = total
+        self.ready = 0
+        self.done = 0
+
+    def status(self):
+        return f"[{self.ready}/{self.total} ready, " \
+               f"{self.done}/{self.total} done]"
+
+    def node_ready(self, node, seconds):
+        self.ready += 1
+        print(f'{self.status()} {self.lab["nodes"][node]["hostname"]} '
+              f"--> Ready ({seconds:.1f}s)")
+
+    def node_done(self, result):
+        self.done += 1
+        print(f'{self.status()} {self.lab["nodes"][result.node]["hostname"]}',
+              end=" ")
+        if result.success:
+            print(f"--> Configuration sent ({result.duration:.1f}s, "
+                  f"{result.sent} bytes)")
+        else:
+            print(f"--> Error: {result.error}")
+
+
+async def push_all(lab, platforms, render, jobs, display, wait_ready):
+    # Every node gets a task in the same event loop. Waiting for nodes to
+    #  boot costs nothing, so all consoles are watched at once, and the
+    #  semaphore keeps at most "jobs" nodes being configured.
+    limit = asyncio.Semaphore(jobs)
+    progress = PushProgress(lab, len(render))
+    tasks = [asyncio.create_task(push_node(node, lab, platforms, render[node],
+                                           display, limit, wait_ready,
+                                           progress))
+             for node in render]
 
+    results = []
+    for task in asyncio.as_completed(tasks):
+        result = await task
+        results.append(result)
+        progress.node_done(result)
 
-def push_configs(node, lab, render, display):
+    return sorted(results)
+
+
+async def push_node(node, lab, platforms, config, display, limit, wait_ready,
+                    progress):
 
     esxi_host = lab["lab_options"]["term_serv"]
     tport = lab["lab_options"]["tport_base"] * 1000 + node
     platform = lab["nodes"][node]["platform"]
 
-    conn = Telnet()
-    conn.set_debuglevel(display)
-    conn.open(host=esxi_host, port=tport, timeout=3)
-
-    # IOS/XE/XR-specific configuration
-    if "ios" in platform or "xrv" in platform or "freertr" in platform:
-
-        # Account for IOS/XE unconfigured state
-        if "ios" in platform:
-            conn.write(b"\r")
-            time.sleep(3)
-            unconf = conn.read_until(b"[yes/no]:", timeout=3)
-            if b"[yes/no]:" in unconf:
-                conn.write("no".encode("ascii") + b"\r")
-                time.sleep(1)
-                conn.read_until("passed code signing verification", timeout=600)
-                conn.write(b"\r")
-                time.sleep(1)
-            conn.write(b"\r")
-            time.sleep(0.3)
-            conn.write("enable".encode("ascii") + b"\r")
-            time.sleep(0.3)
-
-        # Account for XRv unconfigured state
-        if "xrv" in platform:
-            conn.write(b"\r")
-            unconf = conn.read_until(b"Enter root-system username:", timeout=3)
-            if b"root-system username" in unconf:
-                conn.write("xrv".encode("ascii") + b"\r")
-                time.sleep(3)
-                conn.write("xrvadmin".encode("ascii") + b"\r")
-                time.sleep(3)
-                conn.write("xrvadmin".encode("ascii") + b"\r")
-                time.sleep(3)
-            time.sleep(1)
-            conn.write("xrv".encode("ascii") + b"\r")
-            time.sleep(1)
-            conn.write("xrvadmin".encode("ascii") + b"\r")
-            time.sleep(1)
-
-        conn.write(b"\r")
-        conn.write("term len 0".encode("ascii") + b"\r")
-        time.sleep(0.3)
-        conn.write("conf t".encode("ascii") + b"\r")
-        time.sleep(0.3)
-        for line in render[node].split("\n"):
-            conn.write(line.encode("ascii") + b"\r")
-            time.sleep(0.2)
-        if "xrv" in platform:
-            conn.write("commit".encode("ascii") + b"\r")
-            time.sleep(1)
-            conn.write("exit".encode("ascii") + b"\r")
-            time.sleep(0.3)
-        conn.write("exit".encode("ascii") + b"\r")
-        time.sleep(0.3)
-        if "ios" in platform or "freertr" in platform:
-            conn.write("wr".encode("ascii") + b"\r")
-            time.sleep(10)  # Time needed for IOSv writing to GRUB
-            conn.write("exit".encode("ascii") + b"\r")
-        conn.close()
-
-    if "vyos" in platform:
-        conn.write(b"\r")
-        time.sleep(1)
-        conn.write("vyos".encode("ascii") + b"\r")
-        time.sleep(1)
-        conn.write("vyos".encode("ascii") + b"\r")
-        time.sleep(1)
-
-        conn.write(b"\r")
-        conn.write("configure".encode("ascii") + b"\r")
-        time.sleep(0.5)
-        for line in render[node].split("\n"):
-            conn.write(line.encode("ascii") + b"\r")
-            time.sleep(0.2)
-        conn.write("commit".encode("ascii") + b"\r")
-        time.sleep(5)
-        conn.write("set service lldp interface all".encode("ascii") + b"\r")
-        time.sleep(0.3)
-        conn.write("commit".encode("ascii") + b"\r")
-        time.sleep(5)
-        conn.write("save".encode("ascii") + b"\r")
-        time.sleep(0.5)
-        conn.write("exit".encode("ascii") + b"\r")
-        time.sleep(0.3)
-        conn.close()
-
-    if "vmx" in platform:
-        conn.write(b"\r")
-        time.sleep(1)
-        conn.write("root".encode("ascii") + b"\r")
-        time.sleep(1)
-        conn.write("Juniper".encode("ascii") + b"\r")
-        time.sleep(1)
-        conn.write("cli".encode("ascii") + b"\r")
-        time.sleep(1)
-
-        conn.write(b"\r")
-        conn.write("configure".encode("ascii") + b"\r")
-        time.sleep(0.5)
-        for line in render[node].split("\n"):
-            conn.write(line.encode("ascii") + b"\r")
-            time.sleep(0.2)
-        conn.write("set protocols lldp interface all".encode("ascii") + b"\r")
-        time.sleep(0.3)
-        conn.write("commit".encode("ascii") + b"\r")
-        time.sleep(5)
-        conn.write("save config.cfg".encode("ascii") + b"\r")
-        time.sleep(0.5)
-        conn.write("exit".encode("ascii") + b"\r")
-        time.sleep(0.3)
-        conn.close()
-
-    # Other platform-specifics will go below here
-    # if "PLATFORM" in platform:
-
-    print(f"Configuration to node {node} sent.")
-
-
-def config_threads(lab, render):
-
-    multi_threading = input("\n--> Push commands to all devices "
-                            "simultaneously? (y/n): ")
-    if multi_threading.lower() == "y":
-        multi_threading = True
+    # The driver handles everything specific to the platform NOS
+    driver = console_drivers.platform_driver(platforms, platform)
+    if driver is None:
+        return PushResult(node, False, 0.0, None, 0, None,
+                          f"No console driver for platform \"{platform}\"")
+
+    start = time.time()
+    ready = None
+    session = ConsoleSession(esxi_host, tport, display,
+                             driver.command_timeout)
+    error = None
+    try:
+        # A node still powering on refuses the console connection, waiting
+        #  for it to boot also waits for the connection
+        if wait_ready:
+            await driver.wait_ready(session)
+            ready = time.time() - start
+            progress.node_ready(node, ready)
+        else:
+            await session.open()
+
+        async with limit:
+            start = time.time()
+            await driver.configure(session, config)
+    except (OSError, EOFError, ValueError) as e:
+        error = str(e)
+    finally:
+        await session.close()
+
+    return PushResult(node, error is None, time.time() - start, ready,
+                      session.sent, session.last_prompt, error)
+
+
+def config_push(lab, platforms, render):
+
+    simultaneous = input("\n--> Push commands to all devices "
+                         "simultaneously? (y/n): ")
+    if simultaneous.lower() == "y":
+        jobs = lab["lab_options"].get("console_jobs", CONSOLE_JOBS)
     else:
-        multi_threading = False
+        jobs = 1
 
     display = input("\n--> Display configuration progress? (y/n): ")
     if display.lower() == "y":
@@ -152,11 +149,19 @@ def config_threads(lab, render):
     else:
         display = False
 
-    for node in render:
-        print(f"Configuring: {node}")
-        if multi_threading is True:
-            threads = Thread(target=push_configs,
-                             args=(node, lab, render, display))
-            threads.start()
-        else:
-            push_configs(node, lab, render, display)
+    # No need to guess when the lab finished booting, each node is
+    #  configured as soon as its console shows it is ready
+    print(f"\n--> Configuring {len(render)} nodes as they finish booting "
+          f"({jobs} at a time):")
+    start = time.time()
+    results = push_configs(lab, platforms, render, jobs, display,
+                           wait_ready=True)
+
+    failures = [result for result in results.values() if not result.success]
+    print(f"\n--> {len(results) - len(failures)} of {len(results)} nodes "
+          f"configured in {time.time() - start:.1f}s")
+    for result in failures:
+        print(f'    FAILED: {lab["nodes"][result.node]["hostname"]} '
+              f"(last prompt: {result.last_prompt})")
+
+    return results
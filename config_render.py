@@ -2,56 +2,160 @@
 """
 Author: Jedadiah Casey, @Wax_Trax, neckercube.com
 This module renders the configuration from Jinja2 template.
+
+Rendered node configurations are cached (see build_cache.py). A node is
+  only rendered again when the template, the lab options, its own node
+  definition and addresses or the definitions of its neighbors change.
+
+With more than one job, the nodes to render are split across worker
+  processes. Each worker compiles the template and receives the lab once,
+  then only the node number and its interfaces are sent per node. Results
+  come back in node order and the files are written once all nodes are
+  rendered. Rendering falls back to serial if processes are unavailable.
+
+Templates are loaded through templates.py, a node uses the variant of the
+  template for its platform (lab-config.PLATFORM.j2) when there is one.
+  Templates receive the node interfaces with the addresses in the format of
+  the node platform (see address_format.py).
 """
-from jinja2 import Environment, FileSystemLoader
-from netaddr import IPNetwork as ipnet
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import address_format
+import build_cache
+import templates
 
-j2_env = Environment(loader=FileSystemLoader("."))
+# Template and lab of the current (worker) process, set by init_worker
+_worker = {}
 
 
 def render(**kwargs):
 
     lab = kwargs["lab"]
+    platforms = kwargs["platforms"]
     interfaces = kwargs["interfaces"]
     j2_file = kwargs["j2_file"]
     output = kwargs["output"]
-
-    # J2 file passed in from command-line
-    template = j2_env.get_template(j2_file)
+    jobs = kwargs["jobs"]
 
     # Dict to hold configs to pass on to deployment with node ID as key
     rendered_configs = {}
 
-    # Generate the set of nodes from the interface list
-    nodes = sorted(set([int(node[0]) for node in interfaces]))
-
-    # Convert IOS/XE/FreeRTR IPv4 addresses to mask format with netaddr library
-    for iface in interfaces:
-        if "ios" in lab["nodes"][int(iface[0])]["platform"] or \
-                "freertr" in lab["nodes"][int(iface[0])]["platform"]:
-            ipaddr = ipnet(iface[3])
-            ip = str(ipaddr.ip)
-            mask = str(ipaddr.netmask)
-            iface[3] = f"{ip} {mask}"
+    # Nodes and their interfaces come from the interface table indexes
+    nodes = interfaces.nodes()
 
-        # FreeRTR puts a space between IPv6 and /
-        if "freertr" in lab["nodes"][int(iface[0])]["platform"]:
-            ipv6 = iface[4].split("/")
-            iface[4] = f"{ipv6[0]} /{ipv6[1]}"
+    # Cache key of every node
+    keys = node_keys(lab, platforms, interfaces, nodes, j2_file)
 
+    # Reuse cached configurations, only the remaining nodes are rendered
+    rebuild = []
     for node in nodes:
-        node_interfaces = [iface for iface in interfaces
-                           if iface[0] == node]
+        artifact = f"render/{os.path.basename(j2_file)}/{node}"
+        rendered_configs[node] = build_cache.load(lab, artifact, keys[node])
+        if rendered_configs[node] is None:
+            rebuild.append(node)
+
+    rebuilt = set(rebuild)
 
-        render = template.render(lab=lab, node=node, ifaces=node_interfaces)
+    work = [(node, template_interfaces(lab, platforms, interfaces, node))
+            for node in rebuild]
 
+    for node, render in zip(rebuild, render_nodes(lab, j2_file, jobs, work)):
         rendered_configs[node] = render
+        artifact = f"render/{os.path.basename(j2_file)}/{node}"
+        build_cache.store(lab, artifact, keys[node], render)
 
-        # Create configuration text files if output flag specified
-        if output:
-            outfile = f'output/{lab["lab_options"]["lab_name"]}__' \
-                      f'{lab["nodes"][node]["hostname"]}.txt'
-            with open(outfile, "w") as f:
-                f.write(render)
+    for node in nodes:
+        build_cache.record("Node configurations",
+                           lab["nodes"][node]["hostname"], node in rebuilt)
+
+    # Create configuration text files if output flag specified
+    if output:
+        for node in nodes:
+            if node in rebuilt or not os.path.exists(outfile(lab, node)):
+                with open(outfile(lab, node), "w") as f:
+                    f.write(rendered_configs[node])
 
     return rendered_configs
+
+
+def init_worker(j2_file, lab):
+    # J2 file passed in from command-line, each template is compiled once
+    #  per process (or loaded from the bytecode cache)
+    _worker["j2_file"] = j2_file
+    _worker["lab"] = lab
+
+
+def render_node(node, ifaces):
+    # Nodes use the variant of the template for their platform if any
+    lab = _worker["lab"]
+    template = templates.platform_template(_worker["j2_file"],
+                                           lab["nodes"][node]["platform"])
+    return template.render(lab=lab, node=node, ifaces=ifaces)
+
+
+def render_nodes(lab, j2_file, jobs, work):
+    # Render [(node, interfaces)], returning the configurations in order
+    if jobs > 1 and len(work) > 1:
+        workers = min(jobs, len(work))
+        try:
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=init_worker,
+                                     initargs=(j2_file, lab)) as executor:
+                # A few chunks per worker keeps the processes busy without
+                #  sending every node separately
+                chunksize = max(1, len(work) // (workers * 4))
+                return list(executor.map(render_node, *zip(*work),
+                                         chunksize=chunksize))
+        except (OSError, BrokenProcessPool, pickle.PicklingError) as e:
+            print(f"Unable to render in parallel ({e}), rendering serially")
+
+    init_worker(j2_file, lab)
+    return [render_node(node, ifaces) for node, ifaces in work]
+
+
+def template_interfaces(lab, platforms, interfaces, node):
+    # Copies of the node interface records with the addresses in the format
+    #  of the node platform, the interface table itself is not modified
+    return address_format.format_interfaces(
+        interfaces.node_interfaces(node), node_format(lab, platforms, node))
+
+
+def node_format(lab, platforms, node):
+    return address_format.platform_format(platforms,
+                                          lab["nodes"][node]["platform"])
+
+
+def outfile(lab, node):
+    return f'output/{lab["lab_options"]["lab_name"]}__' \
+           f'{lab["nodes"][node]["hostname"]}.txt'
+
+
+def node_keys(lab, platforms, interfaces, nodes, j2_file):
+    # Templates only receive the lab, the node ID and the node interfaces.
+    #  Besides its own definition, a node configuration may refer to its
+    #  neighbors (hostnames in descriptions for example), so their
+    #  definitions are part of the key as well.
+    common = build_cache.digest(
+        templates.template_digest(j2_file),
+        build_cache.source_digest(sys.modules[__name__]),
+        build_cache.source_digest(address_format),
+        lab["lab_options"],
+    )
+
+    keys = {}
+    for node in nodes:
+        neighbors = sorted(set(lab["nodes"][node]["neighbors"]))
+        keys[node] = build_cache.digest(
+            common,
+            node,
+            lab["nodes"][node],
+            node_format(lab, platforms, node),
+            interfaces.node_interfaces(node),
+            [lab["nodes"][neighbor] for neighbor in neighbors],
+        )
+
+    return keys
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This module holds the console drivers used by config_deploy.py to push a
+  configuration over a node serial console (see console_session.py).
+
+A driver knows one NOS: its prompts, how to log in (including getting past
+  an unconfigured first boot), enter configuration mode, send the
+  configuration, commit and save it and leave the console. It also carries
+  its own timeouts, so a slow NOS does not slow down the others.
+
+Platforms select their driver with the driver key of
+  platform_definitions.yaml, a name from DRIVERS. To support a new NOS,
+  subclass ConsoleDriver (or the closest driver) and add it to DRIVERS. A
+  driver must implement login and enter_config, ConsoleDriver is abstract.
+
+Configurations are sent in chunks of lines sized to the console buffer
+  (chunk_size). The next chunk is sent as soon as the echo of the last
+  line of the chunk and the prompt come back, instead of waiting for the
+  prompt after every line. When the output of a chunk shows a line that
+  was not echoed or was rejected (invalid input), the console is left to
+  finish its output and the rest of the configuration is sent again from
+  the start of that chunk one line at a time, so an overrun console never
+  loses part of the configuration. A line rejected then fails the node.
+
+Before configuring, a driver can wait for the node to finish booting: it
+  connects to the console as soon as the VM accepts the connection, then
+  presses return every few seconds until the console shows one of its
+  ready_prompts (a login or CLI prompt, or the first boot dialog).
+"""
+import abc
+import asyncio
+import re
+
+
+def line_end(pattern):
+    # The pattern at the end of a console line. Syslog messages (such as
+    #  %LINK-3-UPDOWN) can be printed on the lines after a prompt, so the
+    #  line may end with a new line as well as with the console output.
+    return pattern + rb" ?(?=[\r\n]|\Z)"
+
+
+def prompt(pattern):
+    # A prompt alone on its console line
+    return rb"(?<![^\r\n])" + line_end(pattern)
+
+
+# Console prompts and messages
+USER_PROMPT = prompt(rb"[\w.:/@-]+>")  # R1>, root>
+EXEC_PROMPT = prompt(rb"[\w.:/@-]+#")  # R1#, RP/0/0/CPU0:xrv#, vyos@vyos#
+CONFIG_PROMPT = prompt(rb"[\w.:/@-]+\([\w-]+\)#")  # R1(config-if)#
+LOGIN_PROMPT = line_end(rb"(?i:username|login):")  # vyos login:
+PASSWORD_PROMPT = line_end(rb"(?i:password):")
+
+# Seconds between two returns pressed on a booting console
+READY_POLL = 10
+
+# Characters of a line compared with its echo, consoles scroll the echo of
+#  lines longer than the terminal
+ECHO_CHECK = 32
+
+# Seconds without console output before lines are sent one at a time after
+#  an overrun chunk, so its late prompts cannot answer them
+DRAIN_QUIET = 2
+
+
+class ConsoleDriver(abc.ABC):
+    # Prompt of configuration mode, every configuration line waits for it
+    config_prompt = CONFIG_PROMPT
+
+    # Lines sent after the node configuration
+    extra_config = []
+
+    # Bytes sent to the console at once, None to send one line at a time
+    chunk_size = 1024
+
+    # Message of a rejected configuration line
+    invalid_input = rb"% ?Invalid input"
+
+    # Console output of a booted node, ready to log in or configure
+    ready_prompts = [LOGIN_PROMPT, USER_PROMPT, EXEC_PROMPT, CONFIG_PROMPT]
+
+    # Seconds to wait for a prompt (None for the console_session default),
+    #  for commit or save to complete and for the node to boot
+    command_timeout = None
+    commit_timeout = 120
+    boot_timeout = 900
+
+    async def wait_ready(self, session):
+        # Open the console and wait until the node finished booting. The
+        #  console refuses the connection until the VM is powered on, and
+        #  pressing return makes a booted console print its prompt again.
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.boot_timeout
+        while True:
+            try:
+                await session.open()
+                break
+            except OSError:
+                if loop.time() >= deadline:
+                    raise ValueError(f"Console {session.host}:"
+                                     f"{session.port} did not accept the "
+                                     f"connection in {self.boot_timeout}s")
+                await asyncio.sleep(
+                    max(min(READY_POLL, deadline - loop.time()), 0.1))
+
+        while True:
+            await session.send("")
+            try:
+                return await session.expect(
+                    self.ready_prompts,
+                    max(min(READY_POLL, deadline - loop.time()), 0.1))
+            except ValueError:
+                if loop.time() >= deadline:
+                    raise ValueError(f"Console {session.host}:{session.port} "
+                                     f"did not finish booting in "
+                                     f"{self.boot_timeout}s")
+
+    async def configure(self, session, config):
+        await self.login(session)
+        await self.enter_config(session)
+        await self.send_config(session, config.split("\n") +
+                               self.extra_config)
+        await self.commit(session)
+        await self.save(session)
+        await self.exit(session)
+
+    @abc.abstractmethod
+    async def login(self, session):
+        # Get to a privileged prompt, whatever state the console is in
+        pass
+
+    @abc.abstractmethod
+    async def enter_config(self, session):
+        pass
+
+    async def send_config(self, session, lines):
+        # Blank lines do nothing in configuration mode and have no echo
+        lines = [line for line in lines if line.strip()]
+
+        if self.chunk_size:
+            for start, end in self.chunks(lines):
+                if not await self.send_chunk(session, lines[start:end]):
+                    # Line mode from this chunk on, once the console
+                    #  finished (a slow one may take as long as a commit)
+                    lines = lines[start:]
+                    await session.drain(DRAIN_QUIET, self.commit_timeout)
+                    break
+            else:
+                return
+
+        # Each line waits for its own echo and the prompt after it, a
+        #  rejected line fails the node
+        for line in lines:
+            await session.command(line, [self.config_prompt],
+                                  echo=line.strip()[:ECHO_CHECK].encode(
+                                      "ascii"))
+            if re.search(self.invalid_input, session.output):
+                raise ValueError(f"Console {session.host}:{session.port} "
+                                 f"rejected \"{line.strip()}\"")
+
+    def restart_point(self, line):
+        # Lines a chunk can start with: sending the chunk again from there
+        #  gives the same result whatever configuration submode the console
+        #  was left in (global commands, not "exit" or indented lines)
+        return not line[0].isspace() and line.strip() not in ("exit", "end")
+
+    def chunks(self, lines):
+        # (start, end) of chunks of at most chunk_size bytes, chunks only
+        #  start at restart points so a block can make a chunk longer
+        start = 0
+        size = 0
+        for index, line in enumerate(lines):
+            if (size + len(line) + 1 > self.chunk_size and index > start
+                    and self.restart_point(line)):
+                yield start, index
+                start = index
+                size = 0
+            size += len(line) + 1
+        if start < len(lines):
+            yield start, len(lines)
+
+    async def send_chunk(self, session, chunk):
+        # Send the lines at once and wait for the echo of the last line and
+        #  the prompt after it, False if any line was dropped or rejected.
+        #  Lines like "exit" repeat, the echo must appear as many times as
+        #  the chunk holds the last line.
+        echoes = [line.strip()[:ECHO_CHECK] for line in chunk]
+        await session.send("\r".join(chunk))
+        try:
+            await session.expect([self.config_prompt],
+                                 echo=echoes[-1].encode("ascii"),
+                                 count=sum(line.count(echoes[-1])
+                                           for line in chunk))
+        except ValueError:
+            return False  # The last line never came back
+
+        if re.search(self.invalid_input, session.output):
+            return False
+
+        # Every line echoed in order
+        output = session.output.decode("ascii", "replace")
+        position = 0
+        for echo in echoes:
+            position = output.find(echo, position)
+            if position < 0:
+                return False
+            position += len(echo)
+        return True
+
+    async def commit(self, session):
+        pass  # Configuration lines apply immediately
+
+    async def save(self, session):
+        pass
+
+    async def exit(self, session):
+        await session.send("exit")
+
+
+class IosDriver(ConsoleDriver):
+    # IOS and IOS-XE
+
+    setup_dialog = line_end(rb"\[yes/no\]:")
+    setup_done = rb"Press RETURN to get started"
+    saved = rb"\[OK\]"
+
+    ready_prompts = [setup_dialog, setup_done, USER_PROMPT, EXEC_PROMPT,
+                     CONFIG_PROMPT]
+
+    # Booting, or leaving the setup dialog of a first boot
+    boot_timeout = 600
+
+    # IOS drops characters pasted faster than its console reads them
+    chunk_size = 512
+
+    async def login(self, session):
+        ready = [self.setup_dialog, USER_PROMPT, EXEC_PROMPT, CONFIG_PROMPT]
+        state = await session.command("", ready)
+        if state == 0:
+            await session.command("no", [self.setup_done], self.boot_timeout)
+            state = await session.command("", ready)
+        if state == 1:
+            await session.command("enable", [EXEC_PROMPT])
+        if state == 3:
+            await session.command("end", [EXEC_PROMPT])
+
+    async def enter_config(self, session):
+        await session.command("term len 0", [EXEC_PROMPT])
+        await session.command("conf t", [CONFIG_PROMPT])
+
+    async def save(self, session):
+        # IOSv takes a while writing to GRUB
+        await session.command("end", [EXEC_PROMPT])
+        await session.command("wr", [self.saved], self.commit_timeout)
+        await session.expect([EXEC_PROMPT])
+
+
+class FreeRtrDriver(IosDriver):
+
+    async def login(self, session):
+        await session.command("", [EXEC_PROMPT])
+
+
+class IosXrDriver(ConsoleDriver):
+
+    root_user = line_end(rb"Enter root-system username:")
+    secret = line_end(rb"Enter secret( again)?:")
+
+    ready_prompts = [root_user, LOGIN_PROMPT, EXEC_PROMPT, CONFIG_PROMPT]
+
+    username = "xrv"
+    password = "xrvadmin"
+
+    # The XR CLI answers slower than IOS on the same host, and XRv takes
+    #  much longer to boot
+    command_timeout = 60
+    boot_timeout = 1800
+
+    async def login(self, session):
+        state = await session.command("", [self.root_user, LOGIN_PROMPT,
+                                           EXEC_PROMPT])
+        if state == 0:
+            await session.command(self.username, [self.secret])
+            await session.command(self.password, [self.secret])
+            await session.command(self.password, [LOGIN_PROMPT])
+            state = 1
+        if state == 1:
+            await session.command(self.username, [PASSWORD_PROMPT])
+            await session.command(self.password, [EXEC_PROMPT])
+
+    async def enter_config(self, session):
+        await session.command("term len 0", [EXEC_PROMPT])
+        await session.command("conf t", [CONFIG_PROMPT])
+
+    async def commit(self, session):
+        await session.command("commit", [CONFIG_PROMPT], self.commit_timeout)
+
+    async def save(self, session):
+        # Committed configurations are already persistent
+        await session.command("end", [EXEC_PROMPT])
+
+
+class VyosDriver(ConsoleDriver):
+
+    operational_prompt = prompt(rb"[\w.@-]+:~\$")  # vyos@vyos:~$
+    config_prompt = EXEC_PROMPT  # vyos@vyos#
+    ready_prompts = [LOGIN_PROMPT, operational_prompt, config_prompt]
+
+    extra_config = ["set service lldp interface all"]
+    invalid_input = rb"Set failed|is not valid"
+
+    username = "vyos"
+    password = "vyos"
+
+    async def login(self, session):
+        state = await session.command("", [LOGIN_PROMPT,
+                                           self.operational_prompt])
+        if state == 0:
+            await session.command(self.username, [PASSWORD_PROMPT])
+            await session.command(self.password, [self.operational_prompt])
+
+    async def enter_config(self, session):
+        await session.command("configure", [self.config_prompt])
+
+    async def commit(self, session):
+        await session.command("commit", [self.config_prompt],
+                              self.commit_timeout)
+
+    async def save(self, session):
+        await session.command("save", [self.config_prompt],
+                              self.commit_timeout)
+        await session.command("exit", [self.operational_prompt])
+
+
+class JunosDriver(ConsoleDriver):
+
+    shell_prompt = prompt(rb"[\w.@-]*:~ #")  # root@:~ #
+    cli_prompt = USER_PROMPT  # root>
+    config_prompt = EXEC_PROMPT  # root#
+    committed = rb"commit complete"
+    ready_prompts = [LOGIN_PROMPT, shell_prompt, cli_prompt, config_prompt]
+
+    extra_config = ["set protocols lldp interface all"]
+    invalid_input = rb"syntax error|unknown command"
+
+    username = "root"
+    password = "Juniper"
+
+    # Junos commits take longer than most
+    commit_timeout = 300
+
+    async def login(self, session):
+        state = await session.command("", [LOGIN_PROMPT, self.shell_prompt,
+                                           self.cli_prompt])
+        if state == 0:
+            await session.command(self.username, [PASSWORD_PROMPT])
+            state = await session.command(self.password, [self.shell_prompt,
+                                                          self.cli_prompt])
+        if state == 1:
+            await session.command("cli", [self.cli_prompt])
+
+    async def enter_config(self, session):
+        await session.command("configure", [self.config_prompt])
+
+    async def commit(self, session):
+        await session.command("commit", [self.committed], self.commit_timeout)
+        await session.expect([self.config_prompt])
+
+    async def save(self, session):
+        await session.command("save config.cfg", [self.config_prompt],
+                              self.commit_timeout)
+        await session.command("exit", [self.cli_prompt])
+
+
+# Driver name (platform_definitions.yaml driver key): driver class
+DRIVERS = {
+    "ios": IosDriver,
+    "iosxr": IosXrDriver,
+    "freertr": FreeRtrDriver,
+    "vyos": VyosDriver,
+    "junos": JunosDriver,
+}
+
+
+# Driver of each platform shipped in platform_definitions.yaml, for
+#  platforms defined without a driver key (None: configurations cannot be
+#  pushed)
+DEFAULT_DRIVERS = {
+    "xrv": "iosxr",
+    "xrv9k": "iosxr",
+    "iosxe": "ios",
+    "iosv": "ios",
+    "iosvl2": "ios",
+    "mikrotik": None,
+    "frr": None,
+    "freertr": "freertr",
+    "vmx": "junos",
+    "vyos": "vyos",
+}
+
+
+def default_driver(platform):
+    # Platforms without a driver key keep the driver of the shipped platform
+    #  with the same name, other platforms have none
+    return DEFAULT_DRIVERS.get(platform)
+
+
+def platform_driver(platforms, platform):
+    # Driver instance for nodes of the platform, None without a driver
+    name = platforms.get(platform, {}).get("driver", default_driver(platform))
+    return DRIVERS[name]() if name else None
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This module drives a lab node serial console (telnet to the ESXi host)
+  the way a person at the console would: send a command, wait for the
+  device to answer with a prompt or a completion message, then send the
+  next one.
+
+- Prompts and messages are regular expressions (bytes), matched against
+  the console output received since the previous match
+- Every wait has a timeout, a device that does not answer in time raises
+  ValueError instead of being sent commands blindly
+- Nothing sleeps for a fixed time, pushing a configuration takes as long
+  as the device needs to accept it
+
+Sessions are asyncio coroutines, so one event loop can drive hundreds of
+  consoles at once (see config_deploy.py). Like telnetlib, the session
+  refuses every telnet option the ESXi host offers and strips telnet
+  commands from the console output.
+"""
+import asyncio
+import re
+import sys
+
+# Seconds to wait for a prompt unless a command gives its own timeout
+COMMAND_TIMEOUT = 30
+
+# Seconds to wait for the ESXi host to accept the console connection
+CONNECT_TIMEOUT = 3
+
+# Telnet commands (RFC 854)
+IAC = 255
+DONT = 254
+DO = 253
+WONT = 252
+WILL = 251
+SB = 250
+SE = 240
+
+
+class ConsoleSession:
+
+    def __init__(self, host, port, display=False, timeout=None):
+        self.host = host
+        self.port = port
+        self.display = display
+        self.timeout = timeout or COMMAND_TIMEOUT
+
+        self.sent = 0  # Bytes sent to the console
+        self.last_prompt = None  # Text of the last prompt or message matched
+        self.output = b""  # Console output up to and including the match
+
+        self.reader = None
+        self.writer = None
+        self.buffer = b""  # Console output not matched yet
+        self.telnet = b""  # Incomplete telnet command from the last read
+
+    async def open(self):
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port),
+                CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise OSError(f"Console {self.host}:{self.port} did not accept "
+                          f"the connection")
+
+    async def send(self, line):
+        # Several lines can be sent at once separated by "\r". Anything the
+        #  device printed since the last match (banners, repeated prompts)
+        #  is dropped so it cannot satisfy the next wait.
+        self.buffer = b""
+        data = line.encode("ascii") + b"\r"
+        self.writer.write(data)
+        self.sent += len(data)
+        await self.writer.drain()
+
+    async def expect(self, patterns, timeout=None, echo=None, count=1):
+        # Wait until the output matches one of the patterns, returning the
+        #  index of the pattern that matched. With echo, the patterns only
+        #  match after the echo was received count times (the last line of
+        #  several lines sent at once), the echoes are counted with a
+        #  single scan of the output.
+        compiled = [re.compile(pattern) for pattern in patterns]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+
+        start = 0  # Where the patterns are searched from
+        seen = 0 if echo else count
+        while True:
+            while seen < count:
+                found = self.buffer.find(echo, start)
+                if found < 0:
+                    # The echo may continue in the next read
+                    start = max(start, len(self.buffer) - len(echo) + 1)
+                    break
+                seen += 1
+                start = found + len(echo)
+
+            for index, pattern in enumerate(compiled):
+                match = pattern.search(self.buffer, start) \
+                    if seen >= count else None
+                if match:
+                    self.output = self.buffer[:match.end()]
+                    self.buffer = self.buffer[match.end():]
+                    self.last_prompt = match.group(0).decode(
+                        "ascii", "replace").strip()
+                    return index
+
+            data = await self.receive(deadline - loop.time())
+            if data is None:
+                waiting = " or ".join(pattern.decode("ascii", "replace")
+                                      for pattern in patterns)
+                raise ValueError(f"Console {self.host}:{self.port} timed out "
+                                 f"waiting for {waiting}")
+            self.buffer += data
+
+    async def drain(self, quiet, timeout=None):
+        # Discard the console output until the device stayed quiet for quiet
+        #  seconds (at most timeout seconds), such as the rest of the output
+        #  of lines sent at once which overran the console
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        while loop.time() < deadline:
+            if await self.receive(quiet) is None:
+                break
+        self.buffer = b""
+
+    async def receive(self, timeout):
+        # Console output of the next read, None if nothing came in time
+        try:
+            data = await asyncio.wait_for(self.reader.read(4096), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if not data:
+            raise EOFError(f"Console {self.host}:{self.port} closed the "
+                           f"connection")
+
+        data = self.negotiate(data)
+        if self.display:
+            sys.stdout.write(data.decode("ascii", "replace"))
+        return data
+
+    async def command(self, line, patterns, timeout=None, echo=None):
+        # Send a line and wait for the device to be ready for the next one
+        await self.send(line)
+        return await self.expect(patterns, timeout, echo)
+
+    def negotiate(self, data):
+        # Strip telnet commands from the received data, refusing every
+        #  option (DO -> WONT, WILL -> DONT), returning the console output
+        data = self.telnet + data
+        self.telnet = b""
+        output = bytearray()
+        replies = bytearray()
+
+        i = 0
+        while i < len(data):
+            if data[i] != IAC:
+                output.append(data[i])
+                i += 1
+                continue
+
+            if i + 1 >= len(data):
+                self.telnet = data[i:]  # Command continues in the next read
+                break
+            command = data[i + 1]
+
+            if command == IAC:  # Escaped 255 data byte
+                output.append(IAC)
+                i += 2
+            elif command in (DO, DONT, WILL, WONT):
+                if i + 2 >= len(data):
+                    self.telnet = data[i:]
+                    break
+                if command == DO:
+                    replies += bytes([IAC, WONT, data[i + 2]])
+                elif command == WILL:
+                    replies += bytes([IAC, DONT, data[i + 2]])
+                i += 3
+            elif command == SB:
+                end = data.find(bytes([IAC, SE]), i + 2)
+                if end < 0:
+                    self.telnet = data[i:]
+                    break
+                i = end + 2
+            else:  # Other commands have no argument
+                i += 2
+
+        if replies:
+            self.writer.write(bytes(replies))
+        return bytes(output)
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass  # Already closed by the device
@@ -3,6 +3,7 @@
 Author: Jedadiah Casey, @Wax_Trax, neckercube.com
 This module generates the ESXi configuration commands.
 """
+import lab_state
 
 
 def esxi_create(**kwargs):
@@ -11,10 +12,10 @@ def esxi_create(**kwargs):
     platforms = kwargs["platforms"]
     output = kwargs["output"]
     deploy = kwargs["deploy"]
+    lease = kwargs["lease"]
     labname = lab["lab_options"]["lab_name"]
 
     # Generate list of neighbor interconnections
-    links = []
     neighbor_interfaces = {}
     for node in lab["nodes"]:
 
@@ -29,49 +30,43 @@ def esxi_create(**kwargs):
             if platforms[platform]["interfaces"][iface]:
                 ifaces.append(iface)
 
-        # Assign interface ID to each neighbor
-        for neighbor in lab["nodes"][node]["neighbors"]:
-            # Reference links between two neighbors by hostname
-            node_name = lab["nodes"][node]["hostname"]
-            neighbor_name = lab["nodes"][neighbor]["hostname"]
-            links.append([node_name, neighbor_name])
-
-            # Interface ID for each neighbor connection
-            neighbor_interfaces[node].append((neighbor, ifaces.pop(0)))
-
-    # Account for multiple links between neighbors (add xNUM to name)
-    multilinks = []
-    for index, value in enumerate(links):
-        total = links.count(value)
-        counter = links[:index].count(value)
-        multilinks.append([value[0] + f"_x{(counter + 1)}", value[1] +
-                          f"_x{(counter + 1)}"] if total > 1 else value)
-    links = multilinks
-
-    # Remove duplicate links (only need A->B, not A->B and B->A)
-    links = sorted(list(set(tuple(sorted(link)) for link in links)))
+        # Interface ID for each neighbor connection
+        for index, neighbor in enumerate(lab["nodes"][node]["neighbors"]):
+            neighbor_interfaces[node].append((neighbor, ifaces[index]))
+
+    # Link table keyed on the node pair (lower node number first), holding
+    #  the port group name of every link between the pair in order
+    link_table = build_link_table(lab)
+
+    # Port groups in name order, which is also the VLAN order
+    links = sorted(pg for pgs in link_table.values() for pg in pgs)
 
     # Generate list of esxcli commands to add/remove portgroups
     portgroup_create = []  # Commands to create ESXi portgroups
     portgroup_remove = []  # Commands to remove ESXi portgroups
+    portgroups = {}  # Port group name with its VLAN
 
     vswitch = lab["lab_options"]["vswitch"]
 
-    vcounter = 10  # Put each PG in its own VLAN for true Layer 2 separation
-    for link in links:
+    # Put each PG in its own VLAN for true Layer 2 separation. VLANs are
+    #  leased per ESXi host and vSwitch so they are kept across runs and
+    #  never shared with other labs.
+    vlans = lab_state.lease_vlans(lab, links, commit=lease)
+
+    for pg in links:
         portgroup_create.append("esxcli network vswitch standard "
                                          f"portgroup add -v {vswitch} "
-                                         f"-p {labname}_{link[0]}---{link[1]}")
+                                         f"-p {pg}")
 
         portgroup_create.append("esxcli network vswitch standard "
-                                         f"portgroup set -v {vcounter} "
-                                         f"-p {labname}_{link[0]}---{link[1]}")
+                                         f"portgroup set -v {vlans[pg]} "
+                                         f"-p {pg}")
 
-        vcounter += 1
+        portgroups[pg] = vlans[pg]
 
         portgroup_remove.append("esxcli network vswitch standard "
                                          f"portgroup remove -v {vswitch} "
-                                         f"-p {labname}_{link[0]}---{link[1]}")
+                                         f"-p {pg}")
 
     # Generate list of commands to create/remove cloned VMs
     clone_vms = []  # Commands to copy base VMs
@@ -79,12 +74,11 @@ def esxi_create(**kwargs):
     telnet_ports = []  # Commands to set VM serial console telnet port
     interface_portgroups = []  # Commands to set VM vNIC portgroups
     register_vms = []  # Commands to register new VMs into ESXi inventory
+    vms = {}  # Per-node VM details used by other deployment modules
 
     pg_base = lab["lab_options"]["pg_base"]
     datastore = lab['lab_options']['datastore']
 
-    temp_links = links + links  # One PG for each side of the connection
-
     for node in lab["nodes"]:
         platform = platforms[lab["nodes"][node]["platform"]]["folder"]
         hostname = lab["nodes"][node]["hostname"]
@@ -92,95 +86,148 @@ def esxi_create(**kwargs):
         node_tport = str(lab["lab_options"]["tport_base"] * 1000 + node)
         vm_location = f"/vmfs/volumes/{datastore}/{labname}_{hostname}"
 
+        clone_mode = platforms[lab["nodes"][node]["platform"]]["clone"]
+
         clone_vms.append(f"sh esxi_thinclone.sh {platform} "
-                         f"{labname}_{hostname}")
+                         f"{labname}_{hostname} {clone_mode}")
         remove_vms.append(f"rm -rf {vm_location}")
+
+        vms[node] = {
+            "name": f"{labname}_{hostname}",
+            "folder": platform,
+            "clone": clone_mode,
+            "location": vm_location,
+            "vmx": f"{vm_location}/{platform}.vmx",
+            "base_tport": platform_port,
+            "tport": int(node_tport),
+            "vnics": {},  # vNIC number with its port group
+        }
         telnet_ports.append(f"sed -i 's/:{platform_port}/:{node_tport}/' "
                             f"{vm_location}/{platform}.vmx")
 
+        # The Nth connection to a neighbor uses the Nth link of the pair
+        link_counter = {}
         for iface in neighbor_interfaces[node]:
             iface_id = iface[1]
-            neighbor_hostname = lab["nodes"][iface[0]]["hostname"]
+            pair = (min(node, iface[0]), max(node, iface[0]))
 
-            for link in temp_links:
-                if (hostname in link[0] or hostname in link[1]) and \
-                   (neighbor_hostname in link[0] or
-                    neighbor_hostname in link[1]):
-                    group = temp_links.pop(temp_links.index(link))
-                    pg = f"{labname}_{group[0]}---{group[1]}"
-                    break  # Only need the first match since it is popped
+            link_index = link_counter.get(pair, 0)
+            link_counter[pair] = link_index + 1
+            pg = link_table[pair][link_index]
 
             vnic = (f"sed -i 's/ethernet{iface_id}.networkName = "
                     f"\"{pg_base}\"/ethernet{iface_id}.networkName = "
                     f"\"{pg}\"/' {vm_location}/{platform}.vmx")
 
             interface_portgroups.append(vnic)
+            vms[node]["vnics"][iface_id] = pg
 
         register_vms.append(f"vim-cmd solo/registervm "
                             f"{vm_location}/{platform}.vmx")
 
+    # Collect the commands to be used for deployment with the -ed flag
+    esxi_commands = {
+        "portgroup_create": portgroup_create,
+        "portgroup_remove": portgroup_remove,
+        "clone_vms": clone_vms,
+        "remove_vms": remove_vms,
+        "telnet_ports": telnet_ports,
+        "interface_portgroups": interface_portgroups,
+        "register_vms": register_vms,
+        "neighbor_interfaces": neighbor_interfaces,
+        "vms": vms,
+        "portgroups": portgroups,
+        "links": link_table,
+    }
+
     # Create a text file with all these commands if output specified
     if output:
-        outfile = f'output/{lab["lab_options"]["lab_name"]}__ESXi_config.txt'
+        write_script(lab, esxi_commands, deploy)
 
-        with open(outfile, "w") as f:
-            f.write("===== ESXi Lab Configuration script: =====\n")
+    return esxi_commands
 
-            f.write("\n--> Create ESXi Lab vSwitch Port Groups:\n")
-            for row in portgroup_create:
-                f.write(f"{row}\n")
 
-            f.write("\n--> Create ESXi Lab VMs:\n")
-            f.write(f"cd /vmfs/volumes/{datastore}\n")
-            for row in clone_vms:
-                f.write(f"{row}\n")
+def script_file(lab):
+    return f'output/{lab["lab_options"]["lab_name"]}__ESXi_config.txt'
 
-            f.write("\n--> Set ESXi Lab VM Telnet Console Ports:\n")
-            for row in telnet_ports:
-                f.write(f"{row}\n")
 
-            f.write("\n--> Set ESXi Lab VM vNIC Port Groups:\n")
-            for row in interface_portgroups:
-                f.write(f"{row}\n")
+def write_script(lab, esxi, deploy):
 
-            f.write("\n--> Register Lab VMs in ESXi Inventory:\n")
-            for row in register_vms:
-                f.write(f"{row}\n")
+    datastore = lab['lab_options']['datastore']
 
-            f.write("\n\n\n===== ESXi Post-Lab Cleanup: =====\n")
+    with open(script_file(lab), "w") as f:
+        f.write("===== ESXi Lab Configuration script: =====\n")
 
-            f.write("\nIMPORTANT: Ensure lab VMs are powered off before "
-                    "proceeding\n")
+        f.write("\n--> Create ESXi Lab vSwitch Port Groups:\n")
+        for row in esxi["portgroup_create"]:
+            f.write(f"{row}\n")
 
-            f.write("\n--> DELETE ESXi Lab VM Directories:\n")
-            for row in remove_vms:
-                f.write(f"{row}\n")
+        f.write("\n--> Create ESXi Lab VMs:\n")
+        f.write(f"cd /vmfs/volumes/{datastore}\n")
+        for row in esxi["clone_vms"]:
+            f.write(f"{row}\n")
 
-            f.write("\n--> DELETE ESXi Lab vSwitch Port Groups:\n")
-            for row in portgroup_remove:
-                f.write(f"{row}\n")
+        f.write("\n--> Set ESXi Lab VM Telnet Console Ports:\n")
+        for row in esxi["telnet_ports"]:
+            f.write(f"{row}\n")
 
-            # Add this message to the file if the lab is not being deployed
-            #  with the -ed flag. If the -ed flag is used, the actual VMIDs
-            #  will be added to this file when the VMs are registered.
-            if not deploy:
-                f.write('\n--> UNREGISTER Lab VMs:\n')
-                f.write('NOTE: If the --esxi-deploy option was not selected, '
-                        'the ESXi VMIDs will be \nunavailable. SSH to the '
-                        'server and issue the command '
-                        '"vim-cmd vmsvc/getallvms", \nthen run the command'
-                        '"vim-cmd vmsvc/unregister VMID"\n\n')
+        f.write("\n--> Set ESXi Lab VM vNIC Port Groups:\n")
+        for row in esxi["interface_portgroups"]:
+            f.write(f"{row}\n")
 
-    # Collect the commands to be used for deployment with the -ed flag
-    esxi_commands = {
-        "portgroup_create": portgroup_create,
-        "portgroup_remove": portgroup_remove,
-        "clone_vms": clone_vms,
-        "remove_vms": remove_vms,
-        "telnet_ports": telnet_ports,
-        "interface_portgroups": interface_portgroups,
-        "register_vms": register_vms,
-        "neighbor_interfaces": neighbor_interfaces,
-    }
+        f.write("\n--> Register Lab VMs in ESXi Inventory:\n")
+        for row in esxi["register_vms"]:
+            f.write(f"{row}\n")
 
-    return esxi_commands
+        f.write("\n\n\n===== ESXi Post-Lab Cleanup: =====\n")
+
+        f.write("\nIMPORTANT: Ensure lab VMs are powered off before "
+                "proceeding\n")
+
+        f.write("\n--> DELETE ESXi Lab VM Directories:\n")
+        for row in esxi["remove_vms"]:
+            f.write(f"{row}\n")
+
+        f.write("\n--> DELETE ESXi Lab vSwitch Port Groups:\n")
+        for row in esxi["portgroup_remove"]:
+            f.write(f"{row}\n")
+
+        # Add this message to the file if the lab is not being deployed
+        #  with the -ed flag. If the -ed flag is used, the actual VMIDs
+        #  will be added to this file when the VMs are registered.
+        if not deploy:
+            f.write('\n--> UNREGISTER Lab VMs:\n')
+            f.write('NOTE: If the --esxi-deploy option was not selected, '
+                    'the ESXi VMIDs will be \nunavailable. SSH to the '
+                    'server and issue the command '
+                    '"vim-cmd vmsvc/getallvms", \nthen run the command'
+                    '"vim-cmd vmsvc/unregister VMID"\n\n')
+
+
+def build_link_table(lab):
+    # Count the links between each pair of nodes. Neighbor lists are
+    #  reciprocal (see validate_nodes.py), so only the lower node is counted.
+    link_counts = {}
+    for node in lab["nodes"]:
+        for neighbor in lab["nodes"][node]["neighbors"]:
+            if node < neighbor:
+                pair = (node, neighbor)
+                link_counts[pair] = link_counts.get(pair, 0) + 1
+
+    labname = lab["lab_options"]["lab_name"]
+
+    link_table = {}
+    for pair, count in link_counts.items():
+        names = [lab["nodes"][pair[0]]["hostname"],
+                 lab["nodes"][pair[1]]["hostname"]]
+
+        link_table[pair] = []
+        for counter in range(1, count + 1):
+            # Account for multiple links between neighbors (add xNUM to name)
+            if count > 1:
+                link = sorted(f"{name}_x{counter}" for name in names)
+            else:
+                link = sorted(names)
+            link_table[pair].append(f"{labname}_{link[0]}---{link[1]}")
+
+    return link_table
@@ -5,8 +5,14 @@ This module uses the output from esxi_create.py to push the commands
  to the ESXi server via SSH session.
 """
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from paramiko import SSHClient, AutoAddPolicy
 
+import esxi_pool
+import esxi_script
+import esxi_vmx
+import lab_state
+
 
 def esxi_deploy(**kwargs):
 
@@ -15,34 +21,116 @@ def esxi_deploy(**kwargs):
     power = kwargs["power"]
     output = kwargs["output"]
     esxi_pass = kwargs["esxi_pass"]
+    script = kwargs["script"]
+    pool = kwargs["pool"]
 
     esxi_host = lab["lab_options"]["term_serv"]
     esxi_username = lab["lab_options"]["esxi_username"]
     datastore = lab['lab_options']['datastore']
-    labname = lab["lab_options"]["lab_name"]
+
+    # Number of concurrent clones allowed on the lab datastore
+    clone_jobs = lab["lab_options"].get("clone_jobs", 1)
 
     ssh = SSHClient()
     ssh.set_missing_host_key_policy(AutoAddPolicy())
     ssh.connect(hostname=esxi_host, username=esxi_username, password=esxi_pass)
 
-    esxi_vmid = []
+    # Claim pre-cloned VMs from the warm pool instead of cloning them
+    if pool:
+        clone_vms, claimed = esxi_pool.claim(ssh, lab, esxi)
+        esxi = dict(esxi, clone_vms=clone_vms)
 
-    print("\n--> Creating VMs:")
-    for vm in esxi["clone_vms"]:
-        print(vm, end=" ")  # puts following status on the same line
-        stdin, stdout, stderr = ssh.exec_command(f"cd /vmfs/volumes/"
-                                                 f"{datastore} && {vm}")
-        time.sleep(0.2)
-        exit_status = stdout.channel.recv_exit_status()
-        if exit_status == 0:
-            print("--> VM created")
+    if script:
+        # The finished VMX files are staged on the datastore for the script
+        esxi = dict(esxi, vmx_files=esxi_vmx.stage_vmx(ssh, lab, esxi))
+
+        # Concurrent clones run over their own channels before the script,
+        #  VMs which failed to clone are neither written nor registered.
+        #  Clones in the script skip those steps themselves.
+        sections = esxi_script.SECTIONS
+        if clone_jobs > 1:
+            cloned = clone_parallel(ssh, esxi["clone_vms"], datastore,
+                                    clone_jobs)
+            failed = failed_vmx(esxi, esxi["vms"], esxi["clone_vms"],
+                                cloned)
+            esxi = dict(esxi,
+                        vmx_files=skip_vms(esxi["vmx_files"], failed),
+                        register_vms=skip_vms(esxi["register_vms"], failed))
+            sections = [section for section in sections
+                        if section[0] != "clone_vms"]
         else:
-            print("--> Error: Unable to clone, or folder already exists")
-            # The script will continue if the VM folder already exists
+            esxi = dict(esxi, clone_vmx=[vm["vmx"] for vm in
+                                         esxi["vms"].values()])
 
-        stdin.close()
-        stdout.close()
-        stderr.close()
+        # Ship the whole plan as one script and run it in a single command
+        results = esxi_script.run_script(ssh, lab, esxi, sections)
+        lines = esxi_script.inventory(results)
+    else:
+        # VMs which failed to clone (or to be claimed from the pool) are
+        #  neither written nor registered
+        cloned = clone_parallel(ssh, esxi["clone_vms"], datastore,
+                                clone_jobs)
+        failed = failed_vmx(esxi, esxi["vms"], esxi["clone_vms"], cloned)
+        nodes = [node for node, vm in esxi["vms"].items()
+                 if vm["vmx"] not in failed]
+
+        esxi_vmx.write_vmx(ssh, lab, esxi, nodes)
+        esxi = dict(esxi, register_vms=skip_vms(esxi["register_vms"],
+                                                failed))
+        lines = command_deploy(ssh, esxi, esxi_host)
+
+    vmids = lab_vmids(lab, lines)
+
+    # Reconciliation only removes VMs and port groups the lab created
+    lab_state.record_resources(lab, "vm", [vm[1] for vm in vmids])
+    lab_state.record_resources(lab, "portgroup", esxi["portgroups"])
+
+    print("\n\n--> ESXi VM configuration complete.\n\n")
+
+    if power:
+        print(f"\n--> Powering on VMs:")
+
+        power_on = []
+        for vm in vmids:  # ('42', 'Lab_ASBR_1B', 'Lab_ASBR_1B/XE-17.3.1a.vmx')
+            print(f"vim-cmd vmsvc/power.on {vm[0]} --> Node {vm[1]}")
+            power_on.append(f"vim-cmd vmsvc/power.on {vm[0]}")
+
+            if not script:
+                stdin, stdout, stderr = ssh.exec_command(power_on[-1])
+                time.sleep(0.2)
+                stdin.close()
+                stdout.close()
+                stderr.close()
+
+        # Script mode powers on every VM with a single command
+        if script and power_on:
+            stdin, stdout, stderr = ssh.exec_command("; ".join(power_on))
+            stdout.channel.recv_exit_status()
+            stdin.close()
+            stdout.close()
+            stderr.close()
+
+    # Replace the claimed pool VMs while the lab boots
+    if pool and claimed:
+        print("\n--> Refilling warm pool:")
+        esxi_pool.refill(ssh, lab, esxi, claimed)
+
+    ssh.close()
+
+    # Add the VMIDs to the output file (if specified) for post-lab cleanup
+    if output:
+        outfile = f'output/{lab["lab_options"]["lab_name"]}__ESXi_config.txt'
+
+        with open(outfile, "a") as f:
+            f.write('\n--> UNREGISTER Lab VMs:\n')
+            for vm in vmids:
+                f.write(f"vim-cmd vmsvc/unregister {vm[0]}\n")
+
+    return vmids
+
+
+def command_deploy(ssh, esxi, esxi_host):
+    # Push each command to the ESXi server with its own SSH command
 
     print("\n--> Creating Port Groups:")
     for pg in esxi["portgroup_create"]:
@@ -53,24 +141,6 @@ def esxi_deploy(**kwargs):
         stdout.close()
         stderr.close()
 
-    print("\n--> Assigning Telnet Console Ports:")
-    for port in esxi["telnet_ports"]:
-        print(port)
-        stdin, stdout, stderr = ssh.exec_command(port)
-        time.sleep(0.2)
-        stdin.close()
-        stdout.close()
-        stderr.close()
-
-    print("\n--> Assigning Port Groups to vNICs:")
-    for vnic in esxi["interface_portgroups"]:
-        print(vnic)
-        stdin, stdout, stderr = ssh.exec_command(vnic)
-        time.sleep(0.2)
-        stdin.close()
-        stdout.close()
-        stderr.close()
-
     print(f"\n--> Registering VMs on {esxi_host}:")
     for reg in esxi["register_vms"]:
         print(reg, end=" ")
@@ -82,18 +152,97 @@ def esxi_deploy(**kwargs):
             print("  --> VM was previously registered")
         else:
             print(f"--> VMID: {vmid}")
-        esxi_vmid.append(vmid)
         stdin.close()
         stdout.close()
         stderr.close()
 
-    # Discover ESXi Lab VMIDs using the lab VM hostnames
+    # Collect the ESXi inventory to discover the lab VMIDs
     stdin, stdout, stderr = ssh.exec_command("vim-cmd vmsvc/getallvms")
     lines = stdout.readlines()
     stdin.close()
     stdout.close()
     stderr.close()
 
+    return lines
+
+
+def clone_vm(ssh, vm, datastore):
+    # Clone a single VM on its own channel of the shared SSH transport
+    start = time.time()
+    stdin, stdout, stderr = ssh.exec_command(f"cd /vmfs/volumes/"
+                                             f"{datastore} && {vm}")
+    exit_status = stdout.channel.recv_exit_status()
+    error = stderr.read().decode(errors="replace").strip()
+    stdin.close()
+    stdout.close()
+    stderr.close()
+
+    return exit_status, time.time() - start, error
+
+
+def clone_parallel(ssh, clones, datastore, jobs):
+    # Run up to "jobs" clones at the same time, multiplexed over one SSH
+    #  connection. Each vmkfstools copy is I/O bound on the datastore, so
+    #  the limit should be raised only as far as the datastore keeps up.
+    #  Returns the clone commands which succeeded.
+    print(f"\n--> Creating VMs ({jobs} concurrent on {datastore}):")
+
+    start = time.time()
+    cloned = []
+    failures = []
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(clone_vm, ssh, vm, datastore): vm
+                   for vm in clones}
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            vm = futures[future]
+            try:
+                exit_status, elapsed, error = future.result()
+            except Exception as e:  # SSH channel failure, keep going
+                exit_status, elapsed, error = -1, 0.0, str(e)
+
+            print(f"[{done}/{len(clones)}] {vm}", end=" ")
+            if exit_status == 0:
+                print(f"--> VM created ({elapsed:.1f}s)")
+                cloned.append(vm)
+            else:
+                print("--> Error: Unable to clone, or folder already exists")
+                failures.append((vm, exit_status, error))
+
+    print(f"\n--> {len(clones) - len(failures)} of {len(clones)} VMs "
+          f"cloned in {time.time() - start:.1f}s")
+    for vm, exit_status, error in failures:
+        print(f"    FAILED ({exit_status}): {vm}")
+        if error:
+            print(f"        {error.splitlines()[-1]}")
+
+    return cloned
+
+
+def failed_vmx(esxi, nodes, clones, cloned):
+    # VMX files of the nodes whose clone command (clones, in node order)
+    #  is not in cloned, each of them is reported as skipped
+    failed = set()
+    for node, command in zip(nodes, clones):
+        if command not in cloned:
+            print(f"--> Skipping VM {esxi['vms'][node]['name']}, "
+                  f"it was not created")
+            failed.add(esxi["vms"][node]["vmx"])
+    return failed
+
+
+def skip_vms(commands, failed):
+    # Commands which do not end with the VMX file of a failed VM (copying
+    #  or registering it)
+    return [command for command in commands
+            if command.split()[-1] not in failed]
+
+
+def lab_vmids(lab, lines):
+    # Discover ESXi Lab VMIDs using the lab VM hostnames
+    labname = lab["lab_options"]["lab_name"]
+
     hostnames = []
     for node in lab["nodes"]:
         hostnames.append(f'{labname}_{lab["nodes"][node]["hostname"]}')
@@ -101,35 +250,12 @@ def esxi_deploy(**kwargs):
     vmids = []
     for line in lines:
         vm = line.split()
+        if len(vm) < 4:
+            continue  # Skip blank or wrapped annotation lines
         vmid = vm[0]  # '156'
         vm_name = vm[1]  # 'Lab_HOSTNAME'
         vmx = vm[3]  # 'Lab_HOSTNAME/XRv-6.3.1.vmx'
         if vm[1] in hostnames:  # Only add VMs belonging to the lab
             vmids.append((vmid, vm_name, vmx))
 
-    print("\n\n--> ESXi VM configuration complete.\n\n")
-
-    if power:
-        print(f"\n--> Powering on VMs:")
-
-        for vm in vmids:  # ('42', 'Lab_ASBR_1B', 'Lab_ASBR_1B/XE-17.3.1a.vmx')
-            print(f"vim-cmd vmsvc/power.on {vm[0]} --> Node {vm[1]}")
-            stdin, stdout, stderr = ssh.exec_command(
-                f"vim-cmd vmsvc/power.on {vm[0]}")
-            time.sleep(0.2)
-            stdin.close()
-            stdout.close()
-            stderr.close()
-
-    ssh.close()
-
-    # Add the VMIDs to the output file (if specified) for post-lab cleanup
-    if output:
-        outfile = f'output/{lab["lab_options"]["lab_name"]}__ESXi_config.txt'
-
-        with open(outfile, "a") as f:
-            f.write('\n--> UNREGISTER Lab VMs:\n')
-            for vm in vmids:
-                f.write(f"vim-cmd vmsvc/unregister {vm[0]}\n")
-
     return vmids
@@ -4,15 +4,22 @@ Author: Jedadiah Casey, @Wax_Trax, neckercube.com
 This script generates and instantiates a networking lab on an ESXi server
 """
 import argparse
+import os
 from getpass import getpass
 
+import build_cache
 import config_deploy
 import config_render
 import esxi_create
 import esxi_deploy
+import esxi_pool
+import esxi_reconcile
 import esxi_remove
+import interface_table
 import ip_generate
 import iterm2_profile
+import lab_pipeline
+import lab_state
 import validate_nodes
 
 # Required file describing the base platform ESXi VMs
@@ -30,17 +37,74 @@ def main(options):
     # Determines whether or not to power on VMs after creation
     power = vars(options)['power']
 
+    # Determines whether or not the ESXi deployment runs as a single script
+    script = vars(options)['esxi_script']
+
+    # Determines whether or not only the lab differences are deployed
+    reconcile = vars(options)['reconcile']
+
+    # Determines whether or not lab VMs are claimed from the warm pool
+    pool = vars(options)['use_pool']
+
+    # Warm pool management commands
+    pool_manage = vars(options)['pool_size'] is not None or \
+        vars(options)['pool_info'] or vars(options)['pool_drain']
+
     # Required YAML file for lab passed as command-line argument
     node_file = vars(options)['node_file']
 
+    # Number of processes rendering node configurations (0 = one per CPU)
+    jobs = vars(options)['jobs'] or os.cpu_count() or 1
+
+    # Optional JSON file receiving the lab validation report
+    report_file = vars(options)['validation_report']
+
     # Jinja2 file for the lab node configurations
     j2_file = vars(options)['node_config']
 
+    # VLANs are only leased when the ESXi configuration is generated or
+    #  deployed
+    lease = vars(options)['esxi_create'] or deploy
+
+    # Determines whether or not generated artifacts are reused from the cache
+    build_cache.enabled = not vars(options)['no_cache']
+
+    # Each stage runs at most once, its result is reused by later stages
+    pipeline = lab_pipeline.Pipeline()
+
     # Ensure base node definitions are valid
-    validated_platforms = validate_nodes.validate_platform_defs(NODE_DEFS)
+    pipeline.add("validate_platforms",
+                 lambda: validate_nodes.validate_platform_defs(NODE_DEFS))
 
     # Ensure lab node definitions are valid
-    lab = validate_nodes.validate_lab_defs(node_file, validated_platforms)
+    pipeline.add("validate_lab",
+                 lambda platforms: validate_nodes.validate_lab_defs(
+                     node_file, platforms, report_file),
+                 ["validate_platforms"])
+
+    # Generate ESXi configuration
+    pipeline.add("plan",
+                 lambda lab, platforms: esxi_gen(lab, platforms, output,
+                                                 deploy, lease),
+                 ["validate_lab", "validate_platforms"])
+
+    # IP assignments are only stored when configurations or output files
+    #  are generated, -ip alone previews them
+    store_ip = output or bool(j2_file)
+
+    # Generate IP addresses for loopbacks and neighbor interconnections
+    pipeline.add("ip_allocate",
+                 lambda lab, platforms, esxi: ip_gen(lab, platforms, esxi,
+                                                     output, store_ip),
+                 ["validate_lab", "validate_platforms", "plan"])
+
+    # Generate node configurations from specified Jinja2 template
+    pipeline.add("render",
+                 lambda lab, platforms, interfaces: lab_render(
+                     lab, platforms, interfaces, j2_file, output, jobs),
+                 ["validate_lab", "validate_platforms", "ip_allocate"])
+
+    lab = pipeline.run("validate_lab")
 
     # Generate iTerm2 dynamic profile
     if vars(options)['iterm2']:
@@ -48,83 +112,198 @@ def main(options):
 
     # Generate ESXI configuration
     if vars(options)['esxi_create']:
-        esxi_gen(lab, validated_platforms, output, deploy)
+        pipeline.run("plan")
 
     # Get ESXi host SSH password if deploying or removing lab configuration
-    if deploy or vars(options)['esxi_remove']:
+    if deploy or vars(options)['esxi_remove'] or pool_manage:
         esxi_pass = getpass("Please enter ESXi host password for username "
                             f'"{lab["lab_options"]["esxi_username"]}": ')
 
     # ESXi deploy
     if deploy:
-        esxi = esxi_gen(lab, validated_platforms, output, deploy)
-        esxi_dep(lab, esxi, power, output, esxi_pass)
+        if reconcile:
+            pipeline.add("deploy",
+                         lambda lab, esxi: esxi_rec(lab, esxi, power, output,
+                                                    esxi_pass),
+                         ["validate_lab", "plan"])
+        else:
+            pipeline.add("deploy",
+                         lambda lab, esxi: esxi_dep(lab, esxi, power, output,
+                                                    esxi_pass, script, pool),
+                         ["validate_lab", "plan"])
+        pipeline.run("deploy")
 
     # ESXi remove
     if vars(options)['esxi_remove']:
-        esxi = esxi_gen(lab, validated_platforms, output, deploy)
-        esxi_rem(lab, esxi, esxi_pass)
+        pipeline.add("remove",
+                     lambda lab, esxi: esxi_rem(lab, esxi, esxi_pass),
+                     ["validate_lab", "plan"])
+        pipeline.run("remove")
+
+    # ESXi warm pool management
+    if pool_manage:
+        pipeline.add("pool",
+                     lambda lab, esxi: esxi_pool.esxi_pool(
+                         lab=lab,
+                         esxi=esxi,
+                         esxi_pass=esxi_pass,
+                         size=vars(options)['pool_size'],
+                         info=vars(options)['pool_info'],
+                         drain=vars(options)['pool_drain'],
+                         ),
+                     ["validate_lab", "plan"])
+        pipeline.run("pool")
 
     # Generate IP addresses for loopbacks and neighbor interconnections
     if vars(options)['ipgen']:
-        esxi = esxi_gen(lab, validated_platforms, output, deploy)
-        ip_gen(lab, validated_platforms, esxi, output)
+        pipeline.run("ip_allocate")
 
     # Generate node configurations from specified Jinja2 template
     if vars(options)['node_config']:
-        esxi = esxi_gen(lab, validated_platforms, output, deploy)
-        interfaces = ip_gen(lab, validated_platforms, esxi, output)
-        render = lab_render(lab, interfaces, j2_file, output)
+        pipeline.run("render")
 
-        # Push device configurations via telnet serial console
+        # Push device configurations via telnet serial console, each node as
+        #  soon as it finished booting
         if vars(options)['push_config']:
-            input(
-                "\n\n--> Please ensure all lab VMs are ready for configuration "
-                "before proceeding. Press enter to continue.")
+            pipeline.add("push",
+                         lambda lab, platforms, render:
+                         config_deploy.config_push(lab, platforms, render),
+                         ["validate_lab", "validate_platforms", "render"])
+            pipeline.run("push")
+
+    # Report which artifacts were rebuilt and which came from the cache
+    build_cache.report()
+
+    # Report how long each stage took
+    if vars(options)['timings']:
+        pipeline.report()
+
+
+def esxi_gen(lab, validated_platforms, output, deploy, lease):
+    key = plan_key(lab, validated_platforms)
+    esxigen = build_cache.load(lab, "plan", key)
+    rebuilt = esxigen is None
+
+    if rebuilt:
+        # Create individual node configurations, VLANs are only leased when
+        #  the ESXi configuration is generated or deployed
+        esxigen = esxi_create.esxi_create(lab=lab,
+                                          platforms=validated_platforms,
+                                          deploy=deploy,
+                                          output=output,
+                                          lease=lease,
+                                          )
+    else:
+        # A plan made without leasing was computed against the same leases
+        #  of every lab (they are part of the key), so leasing its port
+        #  groups now receives the VLANs it already holds
+        if lease:
+            lab_state.lease_vlans(lab, list(esxigen["portgroups"]))
+
+        # Deployments append the VMIDs to the script file, so it is always
+        #  written again when deploying
+        if output and (deploy or not os.path.exists(
+                esxi_create.script_file(lab))):
+            esxi_create.write_script(lab, esxigen, deploy)
+
+    # Stored under the leases after this run, so the next run with the same
+    #  inputs reuses it, leasing or not
+    stored_key = plan_key(lab, validated_platforms)
+    if rebuilt or stored_key != key:
+        build_cache.store(lab, "plan", stored_key, esxigen)
+
+    build_cache.record("ESXi plan", lab["lab_options"]["lab_name"], rebuilt)
 
-            config_deploy.config_threads(lab, render)
+    return esxigen
 
 
-def esxi_gen(lab, validated_platforms, output, deploy):
-    # Create individual node configurations
-    esxigen = esxi_create.esxi_create(lab=lab,
-                                      platforms=validated_platforms,
-                                      deploy=deploy,
-                                      output=output,
-                                      )
-    return esxigen
+def plan_key(lab, validated_platforms):
+    # The plan depends on the VLANs currently leased on the vSwitch by every
+    #  lab as well, new port groups receive the lowest free VLANs
+    return build_cache.digest(lab, validated_platforms,
+                              lab_state.vswitch_leases(lab),
+                              build_cache.source_digest(esxi_create))
 
 
-def esxi_dep(lab, esxi, power, output, esxi_pass):
+def esxi_dep(lab, esxi, power, output, esxi_pass, script, pool):
     # Create individual node configurations
     vmids = esxi_deploy.esxi_deploy(lab=lab,
                                     esxi=esxi,
                                     power=power,
                                     output=output,
                                     esxi_pass=esxi_pass,
+                                    script=script,
+                                    pool=pool,
                                     )
     return vmids
 
 
+def esxi_rec(lab, esxi, power, output, esxi_pass):
+    # Apply only the differences between the lab file and the ESXi server
+    vmids = esxi_reconcile.esxi_reconcile(lab=lab,
+                                          esxi=esxi,
+                                          power=power,
+                                          output=output,
+                                          esxi_pass=esxi_pass,
+                                          )
+    return vmids
+
+
 def esxi_rem(lab, esxi, esxi_pass):
     # Remove ESXi lab configuration
     esxi_remove.esxi_remove(lab=lab, esxi=esxi, esxi_pass=esxi_pass)
 
 
-def ip_gen(lab, validated_platforms, esxi, output):
-    ip = ip_generate.lab_ip_gen(lab=lab,
-                                platforms=validated_platforms,
-                                esxi_interfaces=esxi["neighbor_interfaces"],
-                                output=output,
-                                )
+def ip_gen(lab, validated_platforms, esxi, output, store):
+    ip = build_cache.load(lab, "ip", ip_key(lab, validated_platforms, esxi,
+                                            store))
+    rebuilt = ip is None
+
+    if rebuilt:
+        ip, changes = ip_generate.lab_ip_gen(
+            lab=lab,
+            platforms=validated_platforms,
+            esxi_interfaces=esxi["neighbor_interfaces"],
+            output=output,
+            store=store,
+            )
+        for line in changes:
+            print(line)
+        if not store:
+            print("(IP assignments not saved, use -o or -nc to keep them)")
+
+        # Stored under the IP assignments saved by this run, so the next run
+        #  with the same inputs reuses it
+        build_cache.store(lab, "ip", ip_key(lab, validated_platforms, esxi,
+                                            store), ip)
+    elif output and not os.path.exists(ip_generate.csv_file(lab)):
+        ip_generate.write_csv(lab, ip)
+
+    build_cache.record("IP addressing", lab["lab_options"]["lab_name"],
+                       rebuilt)
+
     return ip
 
 
-def lab_render(lab, interfaces, j2_file, output):
+def ip_key(lab, validated_platforms, esxi, store):
+    # The addresses depend on the IP assignments of the previous run as
+    #  well. A preview does not store them, so its artifact is never reused
+    #  by a run which has to.
+    scheme, assignments = lab_state.ip_assignments(lab)
+    return build_cache.digest(lab, validated_platforms,
+                              esxi["neighbor_interfaces"], store, scheme,
+                              sorted(assignments.items()),
+                              build_cache.source_digest(ip_generate),
+                              build_cache.source_digest(interface_table))
+
+
+def lab_render(lab, platforms, interfaces, j2_file, output, jobs):
     render = config_render.render(lab=lab,
+                                  platforms=platforms,
                                   interfaces=interfaces,
                                   j2_file=j2_file,
                                   output=output,
+                                  jobs=jobs,
                                   )
     return render
 
@@ -163,6 +342,50 @@ if __name__ == "__main__":
                              "to server",
                         dest="esxi_deploy")
 
+    parser.add_argument("-es",
+                        "--esxi-script",
+                        action="store_true",
+                        help="Deploy ESXi lab configuration as a single "
+                             "script in one SSH command (requires -ed)",
+                        dest="esxi_script")
+
+    parser.add_argument("-rc",
+                        "--reconcile",
+                        action="store_true",
+                        help="Compare the lab with the ESXi server and apply "
+                             "only the differences (requires -ed)",
+                        dest="reconcile")
+
+    parser.add_argument("-up",
+                        "--use-pool",
+                        action="store_true",
+                        help="Claim lab VMs from the warm pool of pre-cloned "
+                             "VMs when available (requires -ed)",
+                        dest="use_pool")
+
+    parser.add_argument("-ps",
+                        "--pool-size",
+                        action="store",
+                        type=int,
+                        help="Fill or trim the warm pool to this many "
+                             "pre-cloned VMs for each lab platform",
+                        metavar="SIZE",
+                        dest="pool_size")
+
+    parser.add_argument("-pi",
+                        "--pool-info",
+                        action="store_true",
+                        help="Display the warm pool contents for each lab "
+                             "platform",
+                        dest="pool_info")
+
+    parser.add_argument("-pd",
+                        "--pool-drain",
+                        action="store_true",
+                        help="Remove all ready warm pool VMs for each lab "
+                             "platform",
+                        dest="pool_drain")
+
     parser.add_argument("-er",
                         "--esxi-remove",
                         action="store_true",
@@ -197,15 +420,47 @@ if __name__ == "__main__":
                         metavar="lab-config.j2",
                         dest="node_config")
 
+    parser.add_argument("-j",
+                        "--jobs",
+                        action="store",
+                        type=int,
+                        default=1,
+                        help="Render node configurations in this many "
+                             "processes (0 = one per CPU, default 1)",
+                        metavar="JOBS",
+                        dest="jobs")
+
     parser.add_argument("-pc",
                         "--push-node-configs",
                         action="store_true",
                         help="Push generated lab device configurations "
-                             "(requires -nc and assumes the ESXi "
-                             "portion (-ed) has been fully deployed "
-                             "and booted)",
+                             "(requires -nc and a deployed ESXi portion "
+                             "(-ed), each node is configured as soon as "
+                             "it has booted)",
                         dest="push_config")
 
+    parser.add_argument("-vr",
+                        "--validation-report",
+                        action="store",
+                        type=str,
+                        help="Save the lab validation results (all errors and "
+                             "warnings) to a JSON file",
+                        metavar="report.json",
+                        dest="validation_report")
+
+    parser.add_argument("-nx",
+                        "--no-cache",
+                        action="store_true",
+                        help="Rebuild every generated artifact instead of "
+                             "reusing unchanged ones from the build cache",
+                        dest="no_cache")
+
+    parser.add_argument("-t",
+                        "--timings",
+                        action="store_true",
+                        help="Report the run time of each stage",
+                        dest="timings")
+
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This module manages a warm pool of pre-cloned VMs on the ESXi datastore.
+
+Pool members are unregistered clones of the base platform VMs, stored
+  next to the base VM folder:
+  - FOLDER__pool_N      ready to be claimed by a lab node
+  - FOLDER__poolfill_N  still being cloned in the background
+
+When a lab is deployed with the pool, a ready member is claimed by
+  renaming its folder to the lab VM folder, so only the VMX file and
+  the registration remain. Claimed members are replaced
+  by a background clone on the ESXi server.
+"""
+import re
+from paramiko import SSHClient, AutoAddPolicy
+
+READY = "__pool_"
+FILLING = "__poolfill_"
+
+POOL_MEMBER = re.compile(r"^(?P<folder>\S+?)(?P<state>__pool_|__poolfill_)"
+                         r"(?P<index>\d+)$")
+
+
+def esxi_pool(**kwargs):
+
+    lab = kwargs["lab"]
+    esxi = kwargs["esxi"]
+    esxi_pass = kwargs["esxi_pass"]
+    size = kwargs["size"]
+    info = kwargs["info"]
+    drain = kwargs["drain"]
+
+    if size is not None and size < 0:
+        raise ValueError("Warm pool size cannot be negative")
+
+    esxi_host = lab["lab_options"]["term_serv"]
+    esxi_username = lab["lab_options"]["esxi_username"]
+
+    ssh = SSHClient()
+    ssh.set_missing_host_key_policy(AutoAddPolicy())
+    ssh.connect(hostname=esxi_host, username=esxi_username, password=esxi_pass)
+
+    if drain:
+        pool_drain(ssh, lab, esxi)
+
+    if size is not None:
+        pool_size(ssh, lab, esxi, size)
+
+    if info:
+        pool_info(ssh, lab, esxi)
+
+    ssh.close()
+
+
+def run(ssh, command):
+    # Execute a single command and return its output lines
+    stdin, stdout, stderr = ssh.exec_command(command)
+    lines = stdout.read().decode(errors="replace").splitlines()
+    stdout.channel.recv_exit_status()
+    stdin.close()
+    stdout.close()
+    stderr.close()
+    return lines
+
+
+def lab_platforms(esxi):
+    # Base VM folders (and their clone mode) used by the lab nodes
+    platforms = {}
+    for vm in esxi["vms"].values():
+        platforms[vm["folder"]] = vm["clone"]
+    return platforms
+
+
+def pool_inventory(ssh, lab):
+    # Discover every pool member on the datastore with a single command
+    datastore = lab["lab_options"]["datastore"]
+
+    lines = run(ssh, f"cd /vmfs/volumes/{datastore} && "
+                     f"ls -d *{READY}* *{FILLING}* 2> /dev/null")
+
+    pool = {}
+    for line in lines:
+        member = POOL_MEMBER.match(line.strip().rstrip("/"))
+        if not member:
+            continue
+
+        folder = pool.setdefault(member["folder"], {"ready": [],
+                                                    "filling": []})
+        state = "ready" if member["state"] == READY else "filling"
+        folder[state].append((int(member["index"]), line.strip()))
+
+    for folder in pool.values():
+        folder["ready"].sort()
+        folder["filling"].sort()
+
+    return pool
+
+
+def fill_command(lab, folder, clone, indexes):
+    # Clone pool members one after another in the background so the
+    #  datastore is not saturated while labs are running
+    datastore = lab["lab_options"]["datastore"]
+
+    steps = []
+    for index in indexes:
+        filling = f"{folder}{FILLING}{index}"
+        steps.append(f"sh esxi_thinclone.sh {folder} {filling} {clone} && "
+                     f"mv {filling} {folder}{READY}{index}")
+
+    return (f"cd /vmfs/volumes/{datastore} && nohup sh -c "
+            f"'{'; '.join(steps)}' > /dev/null 2>&1 &")
+
+
+def next_indexes(members, count):
+    # Pool member numbers are never reused while a member exists
+    used = [index for index, name in members["ready"] + members["filling"]]
+    start = max(used) + 1 if used else 1
+    return list(range(start, start + count))
+
+
+def pool_size(ssh, lab, esxi, size):
+
+    datastore = lab["lab_options"]["datastore"]
+    pool = pool_inventory(ssh, lab)
+
+    print(f"\n--> Sizing warm pool to {size} VM(s) per platform:")
+    for folder, clone in lab_platforms(esxi).items():
+        members = pool.get(folder, {"ready": [], "filling": []})
+        current = len(members["ready"]) + len(members["filling"])
+
+        if current < size:
+            indexes = next_indexes(members, size - current)
+            run(ssh, fill_command(lab, folder, clone, indexes))
+            print(f"{folder}: cloning {len(indexes)} pool VM(s) "
+                  f"in the background")
+
+        elif current > size:
+            # Only ready members can be removed, clones in progress finish
+            excess = current - size
+            extra = members["ready"][:max(excess, 0)]
+            for index, name in extra:
+                run(ssh, f"rm -rf /vmfs/volumes/{datastore}/{name}")
+            print(f"{folder}: removed {len(extra)} pool VM(s)")
+            if len(extra) < excess:
+                print(f'{folder}: {len(members["filling"])} pool VM(s) '
+                      f'still cloning, size the pool again once they are '
+                      f'ready to reach {size} VM(s)')
+
+        else:
+            print(f"{folder}: pool already contains {size} VM(s)")
+
+
+def pool_info(ssh, lab, esxi):
+
+    pool = pool_inventory(ssh, lab)
+
+    print("\n--> Warm pool:")
+    print(f'{"Platform folder":<30}{"Ready":>8}{"Filling":>10}')
+    for folder in sorted(set(lab_platforms(esxi)) | set(pool)):
+        members = pool.get(folder, {"ready": [], "filling": []})
+        print(f'{folder:<30}{len(members["ready"]):>8}'
+              f'{len(members["filling"]):>10}')
+
+
+def pool_drain(ssh, lab, esxi):
+
+    datastore = lab["lab_options"]["datastore"]
+    pool = pool_inventory(ssh, lab)
+
+    print("\n--> Draining warm pool:")
+    for folder in lab_platforms(esxi):
+        members = pool.get(folder, {"ready": [], "filling": []})
+        for index, name in members["ready"]:
+            run(ssh, f"rm -rf /vmfs/volumes/{datastore}/{name}")
+        print(f'{folder}: removed {len(members["ready"])} pool VM(s)')
+        if members["filling"]:
+            print(f'{folder}: {len(members["filling"])} pool VM(s) still '
+                  f'cloning, drain again once they are ready')
+
+
+def claim(ssh, lab, esxi):
+    # Replace clone commands with pool member claims where possible
+    pool = pool_inventory(ssh, lab)
+
+    clone_vms = []
+    claimed = {}
+
+    # The VM details and clone commands are both in lab node order
+    for vm, command in zip(esxi["vms"].values(), esxi["clone_vms"]):
+        members = pool.get(vm["folder"], {"ready": []})["ready"]
+
+        if members:
+            index, member = members.pop(0)
+
+            # The lab VM identity is set when its VMX file is written
+            command = f"mv {member} {vm['name']}"
+            claimed[vm["folder"]] = claimed.get(vm["folder"], 0) + 1
+
+        clone_vms.append(command)
+
+    print(f"\n--> Claimed {sum(claimed.values())} of {len(clone_vms)} VMs "
+          f"from the warm pool")
+
+    return clone_vms, claimed
+
+
+def refill(ssh, lab, esxi, claimed):
+    # Replace claimed pool members with background clones
+    pool = pool_inventory(ssh, lab)
+    platforms = lab_platforms(esxi)
+
+    for folder, count in claimed.items():
+        members = pool.get(folder, {"ready": [], "filling": []})
+        indexes = next_indexes(members, count)
+        run(ssh, fill_command(lab, folder, platforms[folder], indexes))
+        print(f"{folder}: refilling {count} pool VM(s) in the background")
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This module compares the lab generated by esxi_create.py with what is
+  actually deployed on the ESXi server and applies only the differences:
+  new nodes, removed nodes, changed links and changed port group VLANs.
+
+The current state is collected with a single SSH command, and the changes
+  are applied with a single generated script (see esxi_script.py).
+"""
+import re
+from paramiko import SSHClient, AutoAddPolicy
+
+import esxi_deploy
+import esxi_script
+import esxi_vmx
+import lab_state
+
+SECTION_MARKER = "@@SECTION "
+
+VMX_SETTING = re.compile(r"^(?P<path>\S+\.vmx):(?P<key>(ethernet|serial)"
+                         r"(?P<id>\d+)\.(networkName|fileName))\s*=\s*"
+                         r"\"(?P<value>.*)\"")
+
+# Reconcile sections in execution order: (action key, heading)
+SECTIONS = [
+    ("power_off", "Powering off VMs to be removed or changed"),
+    ("unregister_vms", "Unregistering removed VMs"),
+    ("remove_vms", "Deleting removed VMs"),
+    ("portgroup_remove", "Deleting removed Port Groups"),
+    ("portgroup_create", "Creating or updating Port Groups"),
+    ("clone_vms", "Creating VMs"),
+    ("vmx_files", "Writing VMX files for new VMs"),
+    ("vmx_edits", "Setting Telnet Console Ports and vNIC Port Groups"),
+    ("reload_vms", "Reloading changed VMs"),
+    ("register_vms", "Registering VMs"),
+    ("power_on", "Powering on changed VMs"),
+]
+
+
+def esxi_reconcile(**kwargs):
+
+    lab = kwargs["lab"]
+    esxi = kwargs["esxi"]
+    power = kwargs["power"]
+    output = kwargs["output"]
+    esxi_pass = kwargs["esxi_pass"]
+
+    esxi_host = lab["lab_options"]["term_serv"]
+    esxi_username = lab["lab_options"]["esxi_username"]
+    datastore = lab["lab_options"]["datastore"]
+    clone_jobs = lab["lab_options"].get("clone_jobs", 1)
+
+    ssh = SSHClient()
+    ssh.set_missing_host_key_policy(AutoAddPolicy())
+    ssh.connect(hostname=esxi_host, username=esxi_username, password=esxi_pass)
+
+    print(f"\n--> Collecting current lab state from {esxi_host}")
+    current = fetch_state(ssh, lab)
+
+    owned = {kind: lab_state.lab_resources(lab, kind)
+             for kind in ("vm", "portgroup")}
+    actions, summary, new_vms, removed = diff_state(lab, esxi, current,
+                                                    owned)
+
+    print("\n--> Lab changes:")
+    for line in summary:
+        print(line)
+
+    if not any(actions.values()):
+        print("\n--> ESXi lab is already up to date.\n\n")
+        vmids = esxi_deploy.lab_vmids(lab, current["getallvms"])
+        record_lab(lab, esxi, removed, vmids)
+        ssh.close()
+        return vmids
+
+    # New VMs get a complete VMX, existing VMs keep theirs and are edited
+    if new_vms:
+        actions["vmx_files"] = esxi_vmx.stage_vmx(ssh, lab, esxi, new_vms)
+
+    # New VMs which failed to clone are neither written nor registered,
+    #  clones in the script skip those steps themselves
+    sections = SECTIONS
+    if clone_jobs > 1 and actions["clone_vms"]:
+        cloned = esxi_deploy.clone_parallel(ssh, actions["clone_vms"],
+                                            datastore, clone_jobs)
+        failed = esxi_deploy.failed_vmx(esxi, new_vms, actions["clone_vms"],
+                                        cloned)
+        for key in ("vmx_files", "register_vms"):
+            actions[key] = esxi_deploy.skip_vms(actions[key], failed)
+        sections = [section for section in sections
+                    if section[0] != "clone_vms"]
+    else:
+        actions["clone_vmx"] = [esxi["vms"][node]["vmx"] for node in new_vms]
+
+    results = esxi_script.run_script(ssh, lab, actions, sections)
+    vmids = esxi_deploy.lab_vmids(lab, esxi_script.inventory(results))
+    record_lab(lab, esxi, removed, vmids)
+
+    print("\n\n--> ESXi lab reconciliation complete.\n\n")
+
+    # Power on only the newly-created VMs, changed VMs were restarted above
+    if power:
+        new_names = [esxi["vms"][node]["name"] for node in new_vms]
+        power_on = [f"vim-cmd vmsvc/power.on {vm[0]}" for vm in vmids
+                    if vm[1] in new_names]
+
+        if power_on:
+            print(f"\n--> Powering on new VMs:")
+            for command in power_on:
+                print(command)
+            stdin, stdout, stderr = ssh.exec_command("; ".join(power_on))
+            stdout.channel.recv_exit_status()
+            stdin.close()
+            stdout.close()
+            stderr.close()
+
+    ssh.close()
+
+    if output:
+        outfile = f'output/{lab["lab_options"]["lab_name"]}__ESXi_config.txt'
+
+        with open(outfile, "a") as f:
+            f.write('\n--> UNREGISTER Lab VMs:\n')
+            for vm in vmids:
+                f.write(f"vim-cmd vmsvc/unregister {vm[0]}\n")
+
+    return vmids
+
+
+def record_lab(lab, esxi, removed, vmids):
+    # The lab now owns its VMs in the ESXi inventory (not those which
+    #  failed to clone) and its port groups, and no longer the removed
+    lab_state.release_resources(lab, "vm", removed["vm"])
+    lab_state.release_resources(lab, "portgroup", removed["portgroup"])
+    lab_state.record_resources(lab, "vm", [vm[1] for vm in vmids])
+    lab_state.record_resources(lab, "portgroup", esxi["portgroups"])
+
+
+def fetch_state(ssh, lab):
+    # Collect everything needed for the comparison with one SSH command
+    datastore = lab["lab_options"]["datastore"]
+    labname = lab["lab_options"]["lab_name"]
+
+    command = (f'echo "{SECTION_MARKER}getallvms"; '
+               f'vim-cmd vmsvc/getallvms; '
+               f'echo "{SECTION_MARKER}portgroups"; '
+               f'esxcli network vswitch standard portgroup list; '
+               f'echo "{SECTION_MARKER}running"; '
+               f'esxcli vm process list; '
+               f'echo "{SECTION_MARKER}folders"; '
+               f'cd /vmfs/volumes/{datastore} && ls -d {labname}_*; '
+               f'echo "{SECTION_MARKER}vmx"; '
+               f'grep -H -E "^(ethernet[0-9]+\\.networkName|'
+               f'serial[0-9]+\\.fileName) " {labname}_*/*.vmx')
+
+    stdin, stdout, stderr = ssh.exec_command(command)
+    lines = stdout.read().decode(errors="replace").splitlines()
+    stdout.channel.recv_exit_status()
+    stdin.close()
+    stdout.close()
+    stderr.close()
+
+    return parse_state(lab, lines)
+
+
+def parse_state(lab, lines):
+
+    labname = lab["lab_options"]["lab_name"]
+    vswitch = lab["lab_options"]["vswitch"]
+
+    sections = {}
+    section = None
+    for line in lines:
+        if line.startswith(SECTION_MARKER):
+            section = line[len(SECTION_MARKER):].strip()
+            sections[section] = []
+        elif section:
+            sections[section].append(line)
+
+    state = {
+        "getallvms": sections.get("getallvms", []),
+        "vmids": {},  # VM name: VMID
+        "portgroups": {},  # Lab port group name: VLAN
+        "running": set(),  # Names of powered-on VMs
+        "folders": set(),  # Lab VM folders on the datastore
+        "vnics": {},  # VM folder: {vNIC number: port group}
+        "tports": {},  # VM folder: telnet port
+    }
+
+    for line in state["getallvms"]:
+        vm = line.split()
+        if len(vm) >= 4 and vm[0].isdigit():
+            state["vmids"][vm[1]] = vm[0]
+
+    # Port group names may contain spaces, so parse from the right
+    for line in sections.get("portgroups", []):
+        pg = line.split()
+        if len(pg) < 4 or not pg[-1].isdigit():
+            continue
+        name = " ".join(pg[:-3])
+        if pg[-3] == vswitch and name.startswith(f"{labname}_"):
+            state["portgroups"][name] = int(pg[-1])
+
+    for line in sections.get("running", []):
+        if line.strip().startswith("Display Name:"):
+            state["running"].add(line.split(":", 1)[1].strip())
+
+    for line in sections.get("folders", []):
+        if line.startswith(f"{labname}_"):
+            state["folders"].add(line.strip().rstrip("/"))
+
+    for line in sections.get("vmx", []):
+        setting = VMX_SETTING.match(line)
+        if not setting:
+            continue
+        folder = setting["path"].split("/")[-2]
+        if setting["key"].startswith("ethernet"):
+            state["vnics"].setdefault(folder, {})[setting["id"]] = \
+                setting["value"]
+        elif setting["value"].startswith("telnet://"):
+            state["tports"][folder] = int(setting["value"].rsplit(":", 1)[1])
+
+    return state
+
+
+def vmx_edit(vm, vnics, tport):
+    # A single sed which sets the telnet port and every changed vNIC
+    edits = []
+    if tport:
+        edits.append(f"-e 's#\\(serial[0-9]*\\.fileName = \"telnet://\\):"
+                     f"[0-9]*\"#\\1:{tport}\"#'")
+    for iface_id, pg in vnics.items():
+        edits.append(f"-e 's/^ethernet{iface_id}\\.networkName = .*/"
+                     f"ethernet{iface_id}.networkName = \"{pg}\"/'")
+    return f"sed -i {' '.join(edits)} {vm['vmx']}"
+
+
+def diff_state(lab, esxi, current, owned):
+    # Owned and removed hold the names of the VMs ("vm") and port groups
+    #  ("portgroup") created by the lab (see lab_state.py) and to be removed
+
+    labname = lab["lab_options"]["lab_name"]
+    vswitch = lab["lab_options"]["vswitch"]
+    datastore = lab["lab_options"]["datastore"]
+    pg_base = lab["lab_options"]["pg_base"]
+
+    actions = {key: [] for key, heading in SECTIONS}
+    summary = []
+    new_vms = []  # Lab node numbers
+    removed = {"vm": [], "portgroup": []}
+
+    desired = {vm["name"]: (node, vm) for node, vm in esxi["vms"].items()}
+
+    # Removed nodes: VMs created by the lab which are not in the lab file.
+    #  Other VMs with the lab name prefix may belong to another lab (lab
+    #  "Lab" and lab "Lab_P1"), they are never removed.
+    deployed = current["folders"] | {name for name in current["vmids"]
+                                     if name.startswith(f"{labname}_")}
+    for name in sorted(deployed - set(desired) - owned["vm"]):
+        summary.append(f"  ? VM {name} was not created by this lab, "
+                       f"left in place")
+    for name in sorted((deployed - set(desired)) & owned["vm"]):
+        removed["vm"].append(name)
+        vmid = current["vmids"].get(name)
+        if name in current["running"] and vmid:
+            actions["power_off"].append(f"vim-cmd vmsvc/power.off {vmid}")
+        if vmid:
+            actions["unregister_vms"].append(
+                f"vim-cmd vmsvc/unregister {vmid}")
+        actions["remove_vms"].append(f"rm -rf /vmfs/volumes/{datastore}/"
+                                     f"{name}")
+        summary.append(f"  - VM {name}")
+
+    # Port groups which are no longer used, new and with a changed VLAN
+    unused = set(current["portgroups"]) - set(esxi["portgroups"])
+    for pg in sorted(unused - owned["portgroup"]):
+        summary.append(f"  ? Port group {pg} was not created by this lab, "
+                       f"left in place")
+    for pg in sorted(unused & owned["portgroup"]):
+        removed["portgroup"].append(pg)
+        actions["portgroup_remove"].append(
+            f"esxcli network vswitch standard portgroup remove "
+            f"-v {vswitch} -p {pg}")
+        summary.append(f"  - Port group {pg}")
+
+    for pg, vlan in esxi["portgroups"].items():
+        if pg not in current["portgroups"]:
+            actions["portgroup_create"].append(
+                f"esxcli network vswitch standard portgroup add "
+                f"-v {vswitch} -p {pg}")
+            summary.append(f"  + Port group {pg} (VLAN {vlan})")
+        elif current["portgroups"][pg] != vlan:
+            summary.append(f"  ~ Port group {pg} VLAN "
+                           f"{current['portgroups'][pg]} -> {vlan}")
+        else:
+            continue
+        actions["portgroup_create"].append(
+            f"esxcli network vswitch standard portgroup set "
+            f"-v {vlan} -p {pg}")
+
+    for name, (node, vm) in desired.items():
+
+        # New nodes are cloned, configured and registered
+        if name not in current["folders"]:
+            new_vms.append(node)
+            actions["clone_vms"].append(
+                f"sh esxi_thinclone.sh {vm['folder']} {name} {vm['clone']}")
+            actions["register_vms"].append(f"vim-cmd solo/registervm "
+                                           f"{vm['vmx']}")
+            summary.append(f"  + VM {name}")
+            continue
+
+        # Existing nodes only get the settings which differ, vNICs of
+        #  removed links go back to the base port group
+        vnics = {iface_id: pg for iface_id, pg in vm["vnics"].items()
+                 if current["vnics"].get(name, {}).get(iface_id) != pg}
+        for iface_id, pg in current["vnics"].get(name, {}).items():
+            if (iface_id not in vm["vnics"] and pg != pg_base
+                    and pg.startswith(f"{labname}_")):
+                vnics[iface_id] = pg_base
+        tport = vm["tport"] \
+            if current["tports"].get(name) != vm["tport"] else None
+
+        vmid = current["vmids"].get(name)
+
+        if vnics or tport:
+            running = name in current["running"] and vmid
+            if running:
+                actions["power_off"].append(f"vim-cmd vmsvc/power.off {vmid}")
+            actions["vmx_edits"].append(vmx_edit(vm, vnics, tport))
+            if vmid:
+                actions["reload_vms"].append(f"vim-cmd vmsvc/reload {vmid}")
+            if running:
+                actions["power_on"].append(f"vim-cmd vmsvc/power.on {vmid}")
+            for iface_id, pg in vnics.items():
+                summary.append(f"  ~ VM {name} vNIC {iface_id} -> {pg}")
+            if tport:
+                summary.append(f"  ~ VM {name} telnet port -> {tport}")
+
+        # Folder exists but the VM is not in the ESXi inventory
+        if not vmid:
+            actions["register_vms"].append(f"vim-cmd solo/registervm "
+                                           f"{vm['vmx']}")
+            summary.append(f"  + Register VM {name}")
+
+    if not summary:
+        summary.append("  (none)")
+
+    return actions, summary, new_vms, removed
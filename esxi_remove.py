@@ -6,6 +6,8 @@ This module removes the ESXi lab configuration from the server.
 import time
 from paramiko import SSHClient, AutoAddPolicy
 
+import lab_state
+
 
 def esxi_remove(**kwargs):
 
@@ -89,4 +91,9 @@ def esxi_remove(**kwargs):
 
         ssh.close()
 
+        # The lab VLANs can now be used by other labs
+        lab_state.release_vlans(lab)
+        lab_state.release_resources(lab, "vm", hostnames)
+        lab_state.release_resources(lab, "portgroup", esxi["portgroups"])
+
         print("\n\n--> Lab has been removed from ESXi server\n\n")
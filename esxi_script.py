@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This module turns the commands generated by esxi_create.py into a single
+  shell script. The script is uploaded to the ESXi server over SFTP and
+  executed with one SSH command instead of one SSH command per step.
+
+Every step in the generated script reports its output and exit status
+  with marker lines, which are parsed back into per-step results:
+  @@OUT <line of step output>
+  @@STEP <section> <index> <exit status>
+
+When a VM fails to clone, the steps writing and registering its VMX file
+  are skipped (exit status -1). The VMX file of every clone command is
+  given in the clone_vmx list, in clone command order.
+"""
+
+OUT_MARKER = "@@OUT "
+STEP_MARKER = "@@STEP "
+
+# Deployment sections in execution order: (esxi_create key, heading)
+SECTIONS = [
+    ("clone_vms", "Creating VMs"),
+    ("portgroup_create", "Creating Port Groups"),
+    ("vmx_files", "Writing VMX files (telnet console ports and vNICs)"),
+    ("register_vms", "Registering VMs"),
+]
+
+# Sections whose steps end with the VMX file of a VM, skipped when the
+#  clone of that VM failed
+VM_SECTIONS = ("vmx_files", "register_vms")
+
+# Exit status reported for a skipped step
+SKIPPED = -1
+
+# Helpers placed at the top of every generated script. The step output is
+#  printed before the step marker so the marker terminates each step.
+#  Failed holds the VMX files of the VMs which failed to clone.
+SCRIPT_HEADER = """#!/bin/sh
+# Generated by esxi_netlab.py, safe to delete
+
+report() {
+  if [ -n "$out" ]; then
+    printf '%s\\n' "$out" | sed 's/^/@@OUT /'
+  fi
+  echo "@@STEP $1 $2 $3"
+}
+
+failed=" "
+
+skipped() {
+  case "$failed" in
+    *" $1 "*) return 0 ;;
+  esac
+  return 1
+}
+"""
+
+
+def script_path(lab):
+    # Location of the uploaded script on the ESXi server
+    return f'/tmp/{lab["lab_options"]["lab_name"]}__esxi_deploy.sh'
+
+
+def build_script(lab, esxi, sections=SECTIONS):
+
+    datastore = lab["lab_options"]["datastore"]
+
+    script = [SCRIPT_HEADER]
+
+    # esxi_thinclone.sh must be executed from the datastore folder
+    script.append(f"cd /vmfs/volumes/{datastore} || exit 1\n")
+
+    clone_vmx = esxi.get("clone_vmx", [])
+
+    for section, heading in sections:
+        script.append(f"\n# {heading}\n")
+        for index, command in enumerate(esxi[section]):
+            run = f"out=$( {{ {command} ; }} 2>&1 )"
+
+            if section == "clone_vms" and index < len(clone_vmx):
+                # Remember the VMX file of a VM which failed to clone
+                script.append(f"{run}\n"
+                              f"status=$?\n"
+                              f"[ $status -eq 0 ] || "
+                              f"failed=\"$failed{clone_vmx[index]} \"\n"
+                              f"report {section} {index} $status\n")
+            elif section in VM_SECTIONS:
+                script.append(f"if skipped {command.split()[-1]}; then\n"
+                              f"  out=\"\"\n"
+                              f"  report {section} {index} {SKIPPED}\n"
+                              f"else\n"
+                              f"  {run}\n"
+                              f"  report {section} {index} $?\n"
+                              f"fi\n")
+            else:
+                script.append(f"{run}\n"
+                              f"report {section} {index} $?\n")
+
+    # Finish with the ESXi inventory so the VMIDs can be discovered
+    script.append("\n# ESXi inventory\n")
+    script.append("out=$( vim-cmd vmsvc/getallvms 2>&1 )\n")
+    script.append("report inventory 0 $?\n")
+
+    return "".join(script)
+
+
+def parse_step(line, pending, esxi):
+    # Convert a step marker line and its pending output into a result
+    section, index, exit_status = line[len(STEP_MARKER):].split()
+    index = int(index)
+
+    result = {
+        "section": section,
+        "index": index,
+        "command": esxi[section][index] if section in esxi else None,
+        "exit_status": int(exit_status),
+        "stdout": pending,
+        "vmid": None,
+    }
+
+    # The VMID is the last line returned by "vim-cmd solo/registervm"
+    if section == "register_vms" and pending:
+        result["vmid"] = pending[-1].strip()
+
+    return result
+
+
+def run_script(ssh, lab, esxi, sections=SECTIONS):
+
+    script = build_script(lab, esxi, sections)
+    remote = script_path(lab)
+
+    # Upload the script using the existing SSH session
+    sftp = ssh.open_sftp()
+    with sftp.open(remote, "w") as f:
+        f.write(script)
+
+    stdin, stdout, stderr = ssh.exec_command(f"sh {remote}")
+
+    results = []
+    pending = []  # Output lines for the step currently executing
+    headings = dict(sections)
+    last_section = None
+
+    # Stream the results back as each step finishes
+    for line in stdout:
+        line = line.rstrip("\n")
+
+        if line.startswith(OUT_MARKER):
+            pending.append(line[len(OUT_MARKER):])
+            continue
+
+        if not line.startswith(STEP_MARKER):
+            continue  # Anything else is not part of a step
+
+        result = parse_step(line, pending, esxi)
+        pending = []
+        results.append(result)
+
+        if result["section"] != last_section and \
+                result["section"] in headings:
+            print(f'\n--> {headings[result["section"]]}:')
+        last_section = result["section"]
+
+        print_result(result)
+
+    exit_status = stdout.channel.recv_exit_status()
+
+    stdin.close()
+    stdout.close()
+    stderr.close()
+
+    sftp.remove(remote)
+    sftp.close()
+
+    if exit_status != 0:
+        raise ValueError(f"ESXi deployment script failed with exit status "
+                         f"{exit_status}, datastore may not exist")
+
+    return results
+
+
+def print_result(result):
+
+    section = result["section"]
+
+    if section == "inventory":
+        return  # Inventory is parsed by the caller
+
+    print(result["command"], end=" ")
+
+    if result["exit_status"] == SKIPPED:
+        print("--> Skipped, the VM was not created")
+    elif section == "clone_vms":
+        if result["exit_status"] == 0:
+            print("--> VM created")
+        else:
+            print("--> Error: Unable to clone, or folder already exists")
+    elif section == "register_vms":
+        if result["vmid"] == "}" or result["exit_status"] != 0:
+            print("  --> VM was previously registered")
+        else:
+            print(f'--> VMID: {result["vmid"]}')
+    elif result["exit_status"] != 0:
+        print(f'--> Error (exit status {result["exit_status"]})')
+    else:
+        print()
+
+
+def inventory(results):
+    # Return the "vim-cmd vmsvc/getallvms" output lines from the results
+    for result in results:
+        if result["section"] == "inventory":
+            return result["stdout"]
+    return []
@@ -1,12 +1,25 @@
 # Adapted from https://github.com/pddenhar/esxi-linked-clone
 # Jedadiah Casey, @Wax_Trax, neckercube.com
 # This script assumes the INFOLDER, vmx and vmdk files have the same name
+#
+# Usage: esxi_thinclone.sh INFOLDER OUTFOLDER [thin|linked]
+#   thin:   copy every VMDK as a thin-provisioned disk (default)
+#   linked: snapshot the base VM once, then give each clone its own delta
+#           disk which uses the base VM disks as a shared read-only parent
 
 set -e
 
 readonly NUMARGS=$#
 readonly INFOLDER=$1
 readonly OUTFOLDER=$2
+readonly MODE=${3:-thin}
+
+# Seconds a linked clone waits for another clone to snapshot the base VM
+readonly SNAPSHOT_WAIT=600
+
+usage() {
+  echo "Usage: $0 INFOLDER OUTFOLDER [thin|linked]"
+}
 
 makeandcopy() {
   mkdir "$OUTFOLDER"
@@ -23,6 +36,76 @@ makeandcopy() {
   cd ..
 }
 
+snapshotbase() {
+  # The base VM only needs to be snapshotted once, its disks then become
+  #  the read-only parent of every linked clone
+  if ls "$INFOLDER"/*-000001.vmdk > /dev/null 2>&1
+  then
+    return
+  fi
+
+  # mkdir is atomic, so only one of several concurrent clones snapshots
+  SNAPSHOT_LOCK="$1".snapshot.lock
+  if mkdir "$SNAPSHOT_LOCK" 2> /dev/null
+  then
+    # Release the lock however the script ends, or later clones would wait
+    #  for it until they time out
+    trap 'rmdir "$SNAPSHOT_LOCK" 2> /dev/null' EXIT
+    trap 'exit 1' INT TERM HUP
+    local vmid
+    vmid=$(vim-cmd solo/registervm "$1$INFOLDER.vmx") || {
+      echo "Unable to register $INFOLDER, ensure the base VM is unregistered"
+      exit 1
+    }
+    vim-cmd vmsvc/snapshot.create "$vmid" linked-clone-base \
+      "Parent disks for linked clones, do not delete" 0 0 > /dev/null
+    vim-cmd vmsvc/unregister "$vmid"
+    rmdir "$SNAPSHOT_LOCK"
+    trap - EXIT INT TERM HUP
+  else
+    local waited=0
+    while [ -d "$SNAPSHOT_LOCK" ]
+    do
+      if [ $waited -ge $SNAPSHOT_WAIT ]
+      then
+        echo "Timed out waiting for the snapshot of $INFOLDER, remove" \
+          "$SNAPSHOT_LOCK if no other clone is running"
+        exit 1
+      fi
+      sleep 1
+      waited=$((waited + 1))
+    done
+  fi
+
+  if ! ls "$INFOLDER"/*-000001.vmdk > /dev/null 2>&1
+  then
+    echo "Unable to snapshot $INFOLDER, ensure the base VM is unregistered"
+    exit 1
+  fi
+}
+
+makeandlink() {
+  snapshotbase "$1"
+
+  mkdir "$OUTFOLDER"
+  cp "$INFOLDER"/"$INFOLDER".vmx "$OUTFOLDER"/
+
+  cd "$INFOLDER"
+
+  # Copy only the (small) snapshot delta disks and their descriptors
+  for f in *-000001.vmdk
+  do
+    cp "$f" ../"$OUTFOLDER"/
+    cp "${f%.vmdk}"-*.vmdk ../"$OUTFOLDER"/
+
+    # Point each delta disk at the shared parent in the base VM folder
+    sed -i -e 's#parentFileNameHint="#parentFileNameHint="'"$1"'#' \
+      ../"$OUTFOLDER"/"$f"
+  done
+
+  cd ..
+}
+
 main() {
   if [ $NUMARGS -le 1 ]
   then
@@ -42,9 +125,21 @@ main() {
     exit 1
   fi
 
-  makeandcopy
-
   local fullbasepath=$(readlink -f "$INFOLDER")/
+
+  case "$MODE" in
+    thin)
+      makeandcopy
+      ;;
+    linked)
+      makeandlink "$fullbasepath"
+      ;;
+    *)
+      usage
+      exit 1
+      ;;
+  esac
+
   cd "$OUTFOLDER"/
 
   # Delete swap file line, will be auto recreated
@@ -65,4 +160,4 @@ main() {
 
 }
 
-main
\ No newline at end of file
+main
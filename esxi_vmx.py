@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This module builds the VMX file for every lab VM locally. Each base
+  platform VMX is downloaded and parsed once per deployment, all per-node
+  edits are made in memory, and each finished VMX is uploaded with a
+  single SFTP write instead of one remote sed per setting.
+
+Per-node edits (previously made by sed in esxi_create.py and
+  esxi_thinclone.sh):
+  - serial port telnet URI changed from the platform port to the node port
+  - ethernetN.networkName set to the node's link port groups
+  - displayName and machine.id set to the lab VM name
+  - swap file name, uuid.location and uuid.bios removed so ESXi
+    generates fresh values
+"""
+import re
+
+# Settings removed from every cloned VM, ESXi recreates them
+REMOVE_SETTINGS = ("sched.swap.derivedName", "uuid.location", "uuid.bios",
+                   "machine.id")
+
+VMX_LINE = re.compile(r'^\s*(?P<key>[^#=\s][^=]*?)\s*=\s*"?(?P<value>.*?)"?\s*$')
+SERIAL_FILE = re.compile(r"^serial\d+\.fileName$", re.IGNORECASE)
+DELTA_DISK = re.compile(r"-\d{6}\.vmdk$")
+
+# Parsed base VMX files: {(ESXi host, VMX path): settings}
+_base_cache = {}
+
+
+def parse_vmx(text):
+    # VMX files are "key = "value"" lines, comments and blanks are dropped
+    settings = {}
+    for line in text.splitlines():
+        setting = VMX_LINE.match(line)
+        if setting:
+            settings[setting["key"]] = setting["value"]
+    return settings
+
+
+def format_vmx(settings):
+    return "".join(f'{key} = "{value}"\n' for key, value in settings.items())
+
+
+def base_vmx(sftp, lab, folder):
+    # Download and parse each base platform VMX only once
+    datastore = lab["lab_options"]["datastore"]
+    path = f"/vmfs/volumes/{datastore}/{folder}/{folder}.vmx"
+    key = (lab["lab_options"]["term_serv"], path)
+
+    if key not in _base_cache:
+        with sftp.open(path, "r") as f:
+            _base_cache[key] = parse_vmx(f.read().decode(errors="replace"))
+
+    return _base_cache[key]
+
+
+def node_vmx(base, vm):
+    # Apply every per-node edit to a copy of the base platform settings
+    settings = {key: value for key, value in base.items()
+                if key not in REMOVE_SETTINGS}
+
+    for key, value in settings.items():
+        # Serial console telnet port
+        if SERIAL_FILE.match(key):
+            settings[key] = value.replace(f":{vm['base_tport']}",
+                                          f":{vm['tport']}")
+
+        # Linked clones use the delta disk created by the base VM snapshot
+        elif vm["clone"] == "linked" and key.endswith(".fileName") and \
+                value.endswith(".vmdk") and not DELTA_DISK.search(value):
+            settings[key] = f"{value[:-len('.vmdk')]}-000001.vmdk"
+
+    for iface_id, pg in vm["vnics"].items():
+        settings[f"ethernet{iface_id}.networkName"] = pg
+
+    settings["displayName"] = vm["name"]
+    settings["machine.id"] = vm["name"]
+
+    return format_vmx(settings)
+
+
+def write_vmx(ssh, lab, esxi, nodes=None):
+    # Overwrite the cloned VMX files in place, one write per VM. Only the
+    #  given nodes are written, the VMs which failed to clone have no VMX.
+    nodes = esxi["vms"] if nodes is None else nodes
+    sftp = ssh.open_sftp()
+
+    print("\n--> Writing VMX files (telnet console ports and vNICs):")
+    for node in nodes:
+        vm = esxi["vms"][node]
+        text = node_vmx(base_vmx(sftp, lab, vm["folder"]), vm)
+        with sftp.open(vm["vmx"], "w") as f:
+            f.write(text)
+
+    sftp.close()
+
+
+def staging_path(lab):
+    # Datastore folder holding the VMX files for script deployments
+    datastore = lab["lab_options"]["datastore"]
+    return f'/vmfs/volumes/{datastore}/.{lab["lab_options"]["lab_name"]}__vmx'
+
+
+def stage_vmx(ssh, lab, esxi, nodes=None):
+    # Upload the finished VMX files before the clones exist, and return the
+    #  commands which copy them into place once the VMs are cloned
+    staging = staging_path(lab)
+    nodes = esxi["vms"] if nodes is None else nodes
+
+    sftp = ssh.open_sftp()
+    try:
+        sftp.mkdir(staging)
+    except IOError:
+        pass  # Left over from a previous deployment
+
+    commands = []
+    for node in nodes:
+        vm = esxi["vms"][node]
+        text = node_vmx(base_vmx(sftp, lab, vm["folder"]), vm)
+        with sftp.open(f"{staging}/{vm['name']}.vmx", "w") as f:
+            f.write(text)
+        commands.append(f"cp {staging}/{vm['name']}.vmx {vm['vmx']}")
+
+    sftp.close()
+
+    commands.append(f"rm -rf {staging}")
+
+    return commands
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This module holds the lab interfaces and their addresses generated by
+  ip_generate.py, with indexes built once so nothing has to rescan the
+  whole interface list.
+
+- Every interface is an InterfaceRecord (a named tuple, so templates can
+  still use iface[2], iface[3] and iface[4])
+- The table keeps the records in generation order and indexes them by
+  node, hostname, link and address
+- Query helpers answer which interface owns an address and what is on the
+  far side of an interface
+- The table exports itself as CSV (the -o IP interfaces file) or JSON
+"""
+import csv
+import json
+from collections import namedtuple
+
+# link is (lower node, higher node, connection number), None for loopbacks
+InterfaceRecord = namedtuple(
+    "InterfaceRecord", ["node", "hostname", "interface", "ipv4", "ipv6",
+                        "link"])
+
+CSV_HEADER = ["ID", "Hostname", "Interface", "IPv4", "IPv6"]
+
+
+def host_address(address):
+    # "192.0.2.1/31" -> "192.0.2.1" (addresses are indexed without prefix)
+    return address.split("/")[0]
+
+
+class InterfaceTable:
+
+    def __init__(self, records):
+        self.records = list(records)
+
+        self.by_node = {}  # Node: [records]
+        self.by_hostname = {}  # Hostname: [records]
+        self.by_link = {}  # Link: [records of both sides]
+        self.by_address = {}  # IPv4 or IPv6 address without prefix: record
+
+        for record in self.records:
+            self.by_node.setdefault(record.node, []).append(record)
+            self.by_hostname.setdefault(record.hostname, []).append(record)
+            if record.link:
+                self.by_link.setdefault(record.link, []).append(record)
+            for address in (record.ipv4, record.ipv6):
+                if address:
+                    self.by_address[host_address(address)] = record
+
+    @classmethod
+    def from_rows(cls, rows, links):
+        # Build from [node, hostname, interface, ipv4, ipv6] rows and the
+        #  link of each row
+        return cls(InterfaceRecord(*row, link) for row, link in
+                   zip(rows, links))
+
+    # The table can be used like the list of records
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        return self.records[index]
+
+    def nodes(self):
+        return sorted(self.by_node)
+
+    def node_interfaces(self, node):
+        return self.by_node.get(node, [])
+
+    def hostname_interfaces(self, hostname):
+        return self.by_hostname.get(hostname, [])
+
+    def owner(self, address):
+        # Interface record using the address (with or without prefix)
+        return self.by_address.get(host_address(address))
+
+    def far_side(self, record):
+        # Interface record on the other end of the link, None for loopbacks
+        for other in self.by_link.get(record.link, []):
+            if other is not record:
+                return other
+        return None
+
+    def rows(self):
+        # [node, hostname, interface, ipv4, ipv6] without the link
+        return [list(record[:5]) for record in self.records]
+
+    def write_csv(self, path):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator="\n")
+            writer.writerow(CSV_HEADER)
+            writer.writerows(record[:5] for record in self.records)
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump([record._asdict() for record in self.records], f,
+                      indent=2)
@@ -11,17 +11,57 @@ IP generation:
   - 10.lower.higher.device/24
   - fd00:lower:higher::device/64
 
-Returns: [node, hostname, interface, ipv4, ipv6]
+Interfaces: interface_table.InterfaceTable of
+  (node, hostname, interface, ipv4, ipv6, link) records
 
 Change the loopback and multi-link base to a different /16 below. When
 multiple links exist between a pair of neighbors, the MULTI_BASE variable
 is used for each connection, going from 1 - 254. The script does not
 currently support more than 254 multi-links across the entire lab.
+
+IP pools:
+The scheme above is used unless the lab options define "ip_pools", in which
+case the addresses are carved from the pools with integer arithmetic:
+- Loopbacks: pool network + node number (/32 and /128)
+- Physical inter-neighbor: one p2p prefix per link (/31 and /127 by
+  default), links ordered by node pair and connection number, the lower
+  node receives the first address. Multi-links are regular links here, so
+  there is no multi-link limit.
+
+  ip_pools:
+    loopback_ipv4: 192.168.0.0/24
+    loopback_ipv6: fd00::/64
+    p2p_ipv4: 10.0.0.0/16
+    p2p_ipv4_prefix: 31 # Optional, default 31
+    p2p_ipv6: fd00:0:0:1::/64
+    p2p_ipv6_prefix: 127 # Optional, default 127
+
+Either address family can be left out, its column is then left empty.
+
+Sticky assignments:
+Link addresses are stored in the lab state database (see lab_state.py)
+and reused on later runs, so adding, removing or reordering neighbors only
+addresses the new links. A link is identified by its node pair and
+connection number. Loopbacks are always derived from the node. Changing
+ip_pools renumbers every link. The assignments are only stored when the
+caller asks for it (store), and every interface whose addressing changed
+since the stored run is returned as a report to the caller.
+
+Returns: (interfaces, report lines)
 """
+import ipaddress
+import json
+import socket
+
+import interface_table
+import lab_state
 
 LOOPBACK_BASE = "192.168"  # MUST be a /16 without second dot
 MULTI_BASE = "172.30"  # MUST be a /16 without second dot, used for multi-links
-CSV_HEADER = '"ID","Hostname","Interface","IPv4","IPv6"\n'
+
+
+# Default p2p prefix lengths per address family
+P2P_PREFIX = {4: 31, 6: 127}
 
 
 def lab_ip_gen(**kwargs):
@@ -30,6 +70,38 @@ def lab_ip_gen(**kwargs):
     platforms = kwargs["platforms"]
     esxi_interfaces = kwargs["esxi_interfaces"]
     output = kwargs["output"]
+    store = kwargs["store"]
+
+    node_links = interface_links(esxi_interfaces)
+
+    # Assignments of the previous run are only reused with the same pools
+    pools = lab["lab_options"].get("ip_pools")
+    scheme = json.dumps(pools, sort_keys=True)
+    previous_scheme, previous = lab_state.ip_assignments(lab)
+    reuse = previous if scheme == previous_scheme else {}
+
+    links = record_links(lab, node_links)
+    if pools:
+        rows = pool_ip_gen(lab, platforms, node_links, reuse)
+    else:
+        rows = legacy_ip_gen(lab, platforms, esxi_interfaces)
+        keep_assignments(rows, links, reuse)
+
+    interfaces = interface_table.InterfaceTable.from_rows(rows, links)
+
+    # Previews leave the stored assignments as they are
+    records = assignment_records(interfaces)
+    if store:
+        lab_state.store_ip_assignments(lab, scheme, records)
+
+    # Create a CSV file with the interfaces and IPs if output specified
+    if output:
+        write_csv(lab, interfaces)
+
+    return interfaces, change_report(lab, previous, records)
+
+
+def legacy_ip_gen(lab, platforms, esxi_interfaces):
 
     interfaces = []
 
@@ -74,14 +146,289 @@ def lab_ip_gen(**kwargs):
 
             interfaces.append([node, hostname, interface, ipv4, ipv6])
 
-    # Create a CSV file with the interfaces and IPs if output specified
-    if output:
-        outfile = f'output/{lab["lab_options"]["lab_name"]}__' \
-                  f'IP_Interfaces.csv'
-        with open(outfile, "w") as f:
-            f.write(CSV_HEADER)
-            for row in interfaces:
-                f.write(f'"{row[0]}","{row[1]}","{row[2]}","{row[3]}",'
-                        f'"{row[4]}"\n')
+    return interfaces
+
+
+def interface_links(esxi_interfaces):
+    # Link identity: (lower node, higher node, connection number). The Nth
+    #  connection between a pair is the Nth time each node lists the other,
+    #  the same rule esxi_create.py uses for the port groups.
+    #  Returns {node: [(link, interface ID)]} in interface order.
+    node_links = {}
+    for node, interface_set in esxi_interfaces.items():
+        seen = {}
+        node_links[node] = []
+        for neighbor, iface_id in interface_set:
+            seen[neighbor] = seen.get(neighbor, 0) + 1
+            link = (min(node, neighbor), max(node, neighbor), seen[neighbor])
+            node_links[node].append((link, iface_id))
+    return node_links
+
+
+def link_name(link):
+    # Name of a link in the lab state database, "lo" for loopbacks
+    if link is None:
+        return "lo"
+    return f"{link[0]}-{link[1]}#{link[2]}"
+
+
+def record_links(lab, node_links):
+    # Link of every interface row, in the order the rows are generated
+    links = [None for node in lab["nodes"]]
+    for entries in node_links.values():
+        links += [link for link, iface_id in entries]
+    return links
+
+
+def assignment_records(interfaces):
+    # (node, link name, interface, ipv4, ipv6) for the lab state database
+    return [(record.node, link_name(record.link), record.interface,
+             record.ipv4, record.ipv6) for record in interfaces]
+
+
+def previous_link(previous, link):
+    # Addresses of both sides of a link in the previous run, or None
+    lower = previous.get((link[0], link_name(link)))
+    higher = previous.get((link[1], link_name(link)))
+    if lower and higher:
+        return lower, higher
+    return None
+
+
+def keep_assignments(interfaces, links, previous):
+    # Default scheme: links of the previous run keep their addresses, new
+    #  links use the generated ones unless those are already taken, then
+    #  the next free multi-link number of the node pair is used instead
+    kept = set()
+    used = set()
+    for row, link in zip(interfaces, links):
+        if link and previous_link(previous, link):
+            ipv4, ipv6 = previous[(row[0], link_name(link))][1:]
+            row[3], row[4] = ipv4, ipv6
+            kept.add(link)
+            used.update((ipv4, ipv6))
+
+    new_links = {}
+    for row, link in zip(interfaces, links):
+        if link and link not in kept:
+            new_links.setdefault(link, []).append(row)
+
+    for link, rows in new_links.items():
+        if any(row[3] in used or row[4] in used for row in rows):
+            for multi_xconnect in range(1, 255):
+                candidates = [legacy_multi(link, row[0], multi_xconnect)
+                              for row in rows]
+                if not any(address in used for pair in candidates
+                           for address in pair):
+                    break
+            else:
+                raise ValueError("This script currently does not support "
+                                 "more than 254 multi-connections in the lab")
+            for row, (ipv4, ipv6) in zip(rows, candidates):
+                row[3], row[4] = ipv4, ipv6
+
+        for row in rows:
+            used.update((row[3], row[4]))
+
+
+def legacy_multi(link, node, multi_xconnect):
+    # Default scheme multi-link addresses of a node
+    return (f'{MULTI_BASE}.{multi_xconnect}.{node}/24',
+            f'fd00:{link[0]}:{link[1]}:{multi_xconnect}::{node}/64')
+
+
+def change_report(lab, previous, records):
+    # Lines reporting every interface whose addressing changed since the
+    #  stored run
+    if not previous:
+        return [f"\n{len(records)} interfaces addressed (no previous IP "
+                f"assignments for this lab)"]
+
+    changes = []
+    current = {}
+    for node, link, interface, ipv4, ipv6 in records:
+        current[(node, link)] = (interface, ipv4, ipv6)
+        before = previous.get((node, link))
+        if before is None:
+            changes.append((node, interface, "new", f"{ipv4} {ipv6}"))
+        elif before != (interface, ipv4, ipv6):
+            changes.append((node, interface, "changed",
+                            f'{" ".join(before)} -> {interface} '
+                            f'{ipv4} {ipv6}'))
+
+    for (node, link), (interface, ipv4, ipv6) in previous.items():
+        if (node, link) not in current:
+            changes.append((node, interface, "removed", f"{ipv4} {ipv6}"))
+
+    report = ["\n===== IP addressing changes ====="]
+    if not changes:
+        report.append("No interface addressing changed")
+    for node, interface, change, detail in changes:
+        hostname = lab["nodes"][node]["hostname"] \
+            if node in lab["nodes"] else node
+        report.append(f"{hostname} {interface}: {change} {detail}")
+
+    return report
+
+
+def pool_ip_gen(lab, platforms, node_links, previous):
+
+    pools = lab["lab_options"]["ip_pools"]
+
+    links = sorted({link for entries in node_links.values()
+                    for link, iface_id in entries})
+
+    nodes = list(lab["nodes"])
+
+    # Addresses of every family, computed in one batch per pool
+    loopbacks = {}
+    p2p = {}
+    for family in (4, 6):
+        loopbacks[family] = loopback_addresses(
+            pools.get(f"loopback_ipv{family}"), family, nodes)
+        p2p[family] = p2p_addresses(
+            pools.get(f"p2p_ipv{family}"),
+            pools.get(f"p2p_ipv{family}_prefix", P2P_PREFIX[family]),
+            family, links, previous)
+
+    interfaces = []
+
+    # Loopbacks
+    for node in nodes:
+        hostname = lab["nodes"][node]["hostname"]
+        interfaces.append([node, hostname, "lo0", loopbacks[4].get(node, ""),
+                           loopbacks[6].get(node, "")])
+
+    # Physical interfaces
+    for node, entries in node_links.items():
+        platform = lab["nodes"][node]["platform"]
+        hostname = lab["nodes"][node]["hostname"]
+
+        for link, iface_id in entries:
+            interface = platforms[platform]["interfaces"][iface_id]
+
+            # The lower-numbered node receives the first address
+            side = 0 if node == link[0] else 1
+            ipv4 = p2p[4][link][side] if p2p[4] else ""
+            ipv6 = p2p[6][link][side] if p2p[6] else ""
+
+            interfaces.append([node, hostname, interface, ipv4, ipv6])
 
     return interfaces
+
+
+def parse_pool(pool, family):
+    # Return the pool as (network integer, prefix length)
+    try:
+        network = ipaddress.ip_network(pool)
+    except (TypeError, ValueError):
+        raise ValueError(f"IP pool \"{pool}\" is not a valid network")
+    if network.version != family:
+        raise ValueError(f"IP pool \"{pool}\" must be an IPv{family} network")
+    return int(network.network_address), network.prefixlen
+
+
+def format_addresses(values, family):
+    # Integer to text conversion for a batch of addresses
+    if family == 4:
+        return [socket.inet_ntoa(value.to_bytes(4, "big"))
+                for value in values]
+    return [socket.inet_ntop(socket.AF_INET6, value.to_bytes(16, "big"))
+            for value in values]
+
+
+def loopback_addresses(pool, family, nodes):
+    # {node: "address/32 or /128"}, the node number is the host part
+    if not pool:
+        return {}
+
+    network, prefix = parse_pool(pool, family)
+    bits = 32 if family == 4 else 128
+    if max(nodes) >= 2 ** (bits - prefix):
+        raise ValueError(f"Loopback pool \"{pool}\" is too small for node "
+                         f"{max(nodes)}")
+
+    addresses = format_addresses([network + node for node in nodes], family)
+    return {node: f"{address}/{bits}"
+            for node, address in zip(nodes, addresses)}
+
+
+def parse_address(address, family):
+    # Integer value of an "address/prefix" string
+    ip = address.split("/")[0]
+    if family == 4:
+        return int.from_bytes(socket.inet_aton(ip), "big")
+    return int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big")
+
+
+def p2p_addresses(pool, link_prefix, family, links, previous):
+    # {link: (lower node address, higher node address)}. Links of the
+    #  previous run keep their prefix, new links receive the lowest free
+    #  prefixes of the pool in link order.
+    if not pool:
+        return None
+
+    network, prefix = parse_pool(pool, family)
+    bits = 32 if family == 4 else 128
+    index = 1 if family == 4 else 2  # Column of previous (iface, v4, v6)
+
+    try:
+        link_prefix = int(link_prefix)
+    except (TypeError, ValueError):
+        raise ValueError(f"Point-to-point prefix length \"{link_prefix}\" "
+                         f"must be a number")
+    if link_prefix < prefix or link_prefix > bits - 1:
+        raise ValueError(f"Point-to-point prefix length /{link_prefix} must "
+                         f"be between /{prefix} and /{bits - 1} for pool "
+                         f"\"{pool}\"")
+
+    # /31 and /127 use both addresses, larger prefixes skip the first
+    #  (subnet-router anycast / network) address
+    size = 2 ** (bits - link_prefix)
+    first = 0 if size == 2 else 1
+    capacity = 2 ** (link_prefix - prefix)
+
+    addresses = {}
+    used = set()  # Prefix numbers within the pool
+    new_links = []
+    for link in links:
+        before = previous_link(previous, link)
+        if before and before[0][index] and before[1][index]:
+            addresses[link] = (before[0][index], before[1][index])
+            used.add((parse_address(addresses[link][0], family) - network)
+                     // size)
+        else:
+            new_links.append(link)
+
+    subnets = []
+    candidate = 0
+    for link in new_links:
+        while candidate in used:
+            candidate += 1
+        if candidate >= capacity:
+            raise ValueError(f"Pool \"{pool}\" only has room for "
+                             f"{capacity} /{link_prefix} links, "
+                             f"{len(links)} needed")
+        subnets.append(network + candidate * size)
+        candidate += 1
+
+    sides = [format_addresses([subnet + first + side for subnet in subnets],
+                              family) for side in (0, 1)]
+    for link, lower, higher in zip(new_links, *sides):
+        addresses[link] = (f"{lower}/{link_prefix}", f"{higher}/{link_prefix}")
+
+    return addresses
+
+
+def csv_file(lab):
+    return f'output/{lab["lab_options"]["lab_name"]}__IP_Interfaces.csv'
+
+
+def json_file(lab):
+    return f'output/{lab["lab_options"]["lab_name"]}__IP_Interfaces.json'
+
+
+def write_csv(lab, interfaces):
+    # The JSON file also holds the link of every interface
+    interfaces.write_csv(csv_file(lab))
+    interfaces.write_json(json_file(lab))
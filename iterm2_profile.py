@@ -5,16 +5,14 @@ This module generates an iTerm2 dynamic profile based on the telnet
   serial console port. The generated file is placed into the user's iTerm2
   preferences folder.
 """
-from jinja2 import Environment, FileSystemLoader
 from os import path
 from uuid import uuid4
 
+import templates
+
 ITERM2_TEMPLATE = "iterm2.j2"
 ITERM2 = "Library/Application Support/iTerm2/DynamicProfiles"
 
-j2_env = Environment(loader=FileSystemLoader("."))
-template = j2_env.get_template(ITERM2_TEMPLATE)
-
 
 def profile_gen(lab):
 
@@ -41,6 +39,7 @@ def profile_gen(lab):
                             lab["nodes"][node]["site"]))
 
     # Create the dynamic profile file and put it in the iTerm2 folder
+    template = templates.get_template(ITERM2_TEMPLATE)
     render = template.render(nodes=sorted(iterm_nodes),
                              lab_name=lab["lab_options"]["lab_name"],
                              term_serv=lab["lab_options"]["term_serv"],
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This module runs the lab generation as a graph of named stages
+  (validate -> plan -> ip allocate -> render -> deploy/push).
+
+- Each stage lists the stages it requires, whose results are passed to it
+  as arguments in the same order
+- Each stage runs at most once per invocation, later requests for the
+  same stage return the cached result
+- The run time of every stage is recorded and can be reported
+"""
+import time
+
+
+class Pipeline:
+
+    def __init__(self):
+        self.stages = {}  # Stage name: (function, required stage names)
+        self.results = {}  # Stage name: result of its single run
+        self.timings = []  # (stage name, seconds) in completion order
+
+    def add(self, name, function, requires=()):
+        # Register a stage, it only runs once its result is requested
+        if name in self.stages:
+            raise ValueError(f"Pipeline stage \"{name}\" is already defined")
+        for required in requires:
+            if required not in self.stages:
+                raise ValueError(f"Pipeline stage \"{name}\" requires "
+                                 f"undefined stage \"{required}\"")
+        self.stages[name] = (function, tuple(requires))
+
+    def run(self, name):
+        # Return the stage result, running it (and its requirements) once
+        if name in self.results:
+            return self.results[name]
+
+        function, requires = self.stages[name]
+        args = [self.run(required) for required in requires]
+
+        start = time.perf_counter()
+        self.results[name] = function(*args)
+        self.timings.append((name, time.perf_counter() - start))
+
+        return self.results[name]
+
+    def report(self):
+        # Print the run time of each stage in the order they completed
+        total = sum(seconds for name, seconds in self.timings)
+
+        print("\n===== Stage timings =====")
+        for name, seconds in self.timings:
+            print(f"{name:<20}{seconds * 1000:>12.1f} ms")
+        print(f'{"total":<20}{total * 1000:>12.1f} ms')
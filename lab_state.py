@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This module keeps local lab state in a small SQLite database so it can be
+  shared between runs and between labs.
+
+VLAN leases:
+- Every lab port group leases a VLAN on its ESXi host and vSwitch
+- Leases are kept across runs, so a port group keeps its VLAN when other
+  links are added or removed
+- Labs on the same host and vSwitch never receive the same VLAN
+- Leases are released when the lab is removed with -er
+
+IP assignments:
+- The addresses of every lab interface are stored with the link they
+  belong to, so later runs keep them (see ip_generate.py)
+- Assignments are kept when the lab is removed, a redeployed lab receives
+  the same addresses
+
+Lab resources:
+- The VMs and port groups a lab created on its ESXi host are recorded, so
+  reconciliation only removes what the lab owns (lab "Lab" never removes
+  the VMs of lab "Lab_P1", although they share the name prefix)
+- Resources are released when they are removed with -er or -rc
+"""
+import os
+import sqlite3
+
+STATE_FILE = "state/esxi_netlab.db"
+
+VLAN_MIN = 10  # VLANs below this are left for the ESXi host itself
+VLAN_MAX = 4094  # 4095 is reserved by ESXi for VLAN trunking
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS vlan_leases (
+    host TEXT NOT NULL,
+    vswitch TEXT NOT NULL,
+    vlan INTEGER NOT NULL,
+    lab TEXT NOT NULL,
+    portgroup TEXT NOT NULL,
+    PRIMARY KEY (host, vswitch, vlan),
+    UNIQUE (host, vswitch, portgroup)
+);
+
+CREATE TABLE IF NOT EXISTS ip_assignments (
+    lab TEXT NOT NULL,
+    node INTEGER NOT NULL,
+    link TEXT NOT NULL,
+    interface TEXT NOT NULL,
+    ipv4 TEXT NOT NULL,
+    ipv6 TEXT NOT NULL,
+    PRIMARY KEY (lab, node, link)
+);
+
+CREATE TABLE IF NOT EXISTS ip_schemes (
+    lab TEXT PRIMARY KEY,
+    scheme TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS lab_resources (
+    host TEXT NOT NULL,
+    lab TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (host, kind, name)
+);
+"""
+
+
+def connect():
+    # Open (and create if needed) the lab state database
+    folder = os.path.dirname(STATE_FILE)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    db = sqlite3.connect(STATE_FILE, timeout=30)
+    db.executescript(SCHEMA)
+    return db
+
+
+def lab_key(lab):
+    return (lab["lab_options"]["term_serv"], lab["lab_options"]["vswitch"],
+            lab["lab_options"]["lab_name"])
+
+
+def lease_vlans(lab, portgroups, commit=True):
+    # Return {port group: VLAN} for every lab port group. Existing leases
+    #  are kept, unused leases of the lab are released and new port groups
+    #  lease the lowest free VLANs, all in a single transaction. Without
+    #  commit, the same result is returned but nothing is stored.
+    host, vswitch, labname = lab_key(lab)
+
+    db = connect()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+
+        leased = dict(db.execute(
+            "SELECT portgroup, vlan FROM vlan_leases "
+            "WHERE host = ? AND vswitch = ? AND lab = ?",
+            (host, vswitch, labname)))
+
+        # Port groups of the lab which no longer exist
+        released = [pg for pg in leased if pg not in portgroups]
+        db.executemany(
+            "DELETE FROM vlan_leases WHERE host = ? AND vswitch = ? "
+            "AND portgroup = ?", [(host, vswitch, pg) for pg in released])
+
+        used = {vlan for vlan, in db.execute(
+            "SELECT vlan FROM vlan_leases WHERE host = ? AND vswitch = ?",
+            (host, vswitch))}
+
+        vlans = {}
+        new_leases = []
+        candidate = VLAN_MIN
+        for pg in portgroups:
+            if pg in leased:
+                vlans[pg] = leased[pg]
+                continue
+
+            while candidate in used:
+                candidate += 1
+            if candidate > VLAN_MAX:
+                raise ValueError(f"No free VLANs left on vSwitch \"{vswitch}\""
+                                 f" of \"{host}\" ({VLAN_MIN} - {VLAN_MAX} "
+                                 f"in use), remove unused labs first")
+
+            vlans[pg] = candidate
+            used.add(candidate)
+            new_leases.append((host, vswitch, candidate, labname, pg))
+
+        db.executemany("INSERT INTO vlan_leases VALUES (?, ?, ?, ?, ?)",
+                       new_leases)
+
+        if commit:
+            db.commit()
+        else:
+            db.rollback()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    return vlans
+
+
+def release_vlans(lab):
+    # Release every VLAN leased by the lab
+    host, vswitch, labname = lab_key(lab)
+
+    db = connect()
+    with db:
+        db.execute("DELETE FROM vlan_leases "
+                   "WHERE host = ? AND vswitch = ? AND lab = ?",
+                   (host, vswitch, labname))
+    db.close()
+
+
+def vswitch_leases(lab):
+    # Return [(VLAN, lab, port group)] currently leased on the ESXi host and
+    #  vSwitch of the lab, by every lab
+    host, vswitch, labname = lab_key(lab)
+
+    db = connect()
+    leases = db.execute(
+        "SELECT vlan, lab, portgroup FROM vlan_leases "
+        "WHERE host = ? AND vswitch = ? ORDER BY vlan",
+        (host, vswitch)).fetchall()
+    db.close()
+
+    return leases
+
+
+def ip_assignments(lab):
+    # Return (scheme, {(node, link): (interface, ipv4, ipv6)}) stored by the
+    #  previous IP generation of the lab, scheme is None without one
+    labname = lab["lab_options"]["lab_name"]
+
+    db = connect()
+    row = db.execute("SELECT scheme FROM ip_schemes WHERE lab = ?",
+                     (labname,)).fetchone()
+    assignments = {(node, link): (interface, ipv4, ipv6)
+                   for node, link, interface, ipv4, ipv6 in db.execute(
+                       "SELECT node, link, interface, ipv4, ipv6 "
+                       "FROM ip_assignments WHERE lab = ?", (labname,))}
+    db.close()
+
+    return (row[0] if row else None), assignments
+
+
+def store_ip_assignments(lab, scheme, records):
+    # Replace the stored assignments of the lab with records of
+    #  (node, link, interface, ipv4, ipv6)
+    labname = lab["lab_options"]["lab_name"]
+
+    db = connect()
+    with db:
+        db.execute("DELETE FROM ip_assignments WHERE lab = ?", (labname,))
+        db.executemany("INSERT INTO ip_assignments VALUES (?, ?, ?, ?, ?, ?)",
+                       [(labname, *record) for record in records])
+        db.execute("INSERT OR REPLACE INTO ip_schemes VALUES (?, ?)",
+                   (labname, scheme))
+    db.close()
+
+
+def lab_resources(lab, kind):
+    # Return the names of the resources of a kind ("vm" or "portgroup")
+    #  the lab created on its ESXi host
+    host, vswitch, labname = lab_key(lab)
+
+    db = connect()
+    names = {name for name, in db.execute(
+        "SELECT name FROM lab_resources "
+        "WHERE host = ? AND lab = ? AND kind = ?", (host, labname, kind))}
+    db.close()
+
+    return names
+
+
+def record_resources(lab, kind, names):
+    # Record resources created by the lab, a name belongs to the lab which
+    #  created it last
+    host, vswitch, labname = lab_key(lab)
+
+    db = connect()
+    with db:
+        db.executemany("INSERT OR REPLACE INTO lab_resources "
+                       "VALUES (?, ?, ?, ?)",
+                       [(host, labname, kind, name) for name in names])
+    db.close()
+
+
+def release_resources(lab, kind, names):
+    # Forget resources of the lab which were removed from its ESXi host
+    host, vswitch, labname = lab_key(lab)
+
+    db = connect()
+    with db:
+        db.executemany("DELETE FROM lab_resources "
+                       "WHERE host = ? AND lab = ? AND kind = ? AND name = ?",
+                       [(host, labname, kind, name) for name in names])
+    db.close()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This module loads the Jinja2 templates used by the other modules (node
+  configurations and the iTerm2 profile) from a single shared environment.
+
+- Compiled templates are kept for the whole run, every stage reuses them
+- Template bytecode is cached on disk, so later runs skip compiling the
+  template source
+- A lab template can have per-platform variants named after the platform
+  key of platform_definitions.yaml, e.g. lab-config.xrv.j2 is used for
+  "xrv" nodes instead of lab-config.j2. Nodes of platforms without a
+  variant use the main template.
+"""
+import glob
+import os
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+import build_cache
+
+TEMPLATE_DIR = "."
+
+_env = []  # The shared environment, created on first use
+_templates = {}  # (template file, platform): compiled template
+
+
+def environment():
+    if not _env:
+        # Created on first use so the cache location can still be changed
+        bytecode_dir = os.path.join(build_cache.CACHE_DIR, "jinja2")
+        os.makedirs(bytecode_dir, exist_ok=True)
+        _env.append(Environment(
+            loader=FileSystemLoader(TEMPLATE_DIR),
+            bytecode_cache=FileSystemBytecodeCache(bytecode_dir)))
+    return _env[0]
+
+
+def get_template(j2_file):
+    return platform_template(j2_file, None)
+
+
+def variant_name(j2_file, platform):
+    # lab-config.j2 -> lab-config.PLATFORM.j2
+    stem, extension = os.path.splitext(j2_file)
+    return f"{stem}.{platform}{extension}"
+
+
+def platform_template(j2_file, platform):
+    # Compiled template for nodes of the platform, the platform variant of
+    #  the template when it exists
+    if (j2_file, platform) not in _templates:
+        name = j2_file
+        if platform and os.path.exists(os.path.join(
+                TEMPLATE_DIR, variant_name(j2_file, platform))):
+            name = variant_name(j2_file, platform)
+        _templates[(j2_file, platform)] = environment().get_template(name)
+    return _templates[(j2_file, platform)]
+
+
+def template_digest(j2_file):
+    # Content hash of the template and all its platform variants (which may
+    #  include each other)
+    stem, extension = os.path.splitext(os.path.join(TEMPLATE_DIR, j2_file))
+    files = [os.path.join(TEMPLATE_DIR, j2_file)]
+    files += sorted(glob.glob(f"{glob.escape(stem)}.*{extension}"))
+    return build_cache.digest(*[build_cache.file_digest(f) for f in files])
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+"""
+Author: Jedadiah Casey, @Wax_Trax, neckercube.com
+This module generates lab YAML files for parameterized topologies, mainly to
+  create labs of any size for scale testing and benchmarks.
+
+Topologies:
+- ring: every node connects to the next one, the last back to the first
+- mesh: every node connects to every other node
+- leaf-spine: every leaf connects to every spine (optionally several times)
+- sp-core: sites of P routers (full mesh per site) with dual-homed PEs and
+  route reflectors, the sites connected to each other in a ring
+- random: connected random graph with a maximum number of neighbors per node
+
+Every generated lab is checked against the interface count of its platforms
+  and the 1 - 254 node/site limits, then validated like any other lab file.
+
+API: lab = generate("ring", platforms, nodes=10, platform="iosxe")
+CLI: python topology_gen.py ring -n 10 -p iosxe -f ring10.yaml
+"""
+import argparse
+import random
+
+import validate_nodes
+
+# Required file describing the base platform ESXi VMs
+NODE_DEFS = "platform_definitions.yaml"
+
+MAX_NODES = 254  # Node numbers are used in IP addresses, see ip_generate.py
+
+# Default lab options, override any of them with the options argument
+LAB_OPTIONS = {
+    "lab_name": "Generated-Lab",
+    "term_serv": "10.0.0.1",
+    "esxi_username": "root",
+    "tport_base": 20,
+    "datastore": "datastore1",
+    "vswitch": "vSwitch1",
+    "pg_base": "Lab",
+}
+
+
+def interface_count(platforms, platform):
+    # Interfaces usable for neighbors (blank interfaces are not)
+    if platform not in platforms:
+        raise ValueError(f"Platform \"{platform}\" not in available platform "
+                         f"definitions")
+    return sum(1 for iface in platforms[platform]["interfaces"].values()
+               if iface)
+
+
+def build_lab(nodes, links, platforms, options=None):
+    # nodes: [(hostname, platform, site)] numbered from 1 in list order
+    # links: [(node, node)] one entry per connection, repeats are multi-links
+    if len(nodes) > MAX_NODES:
+        raise ValueError(f"Topology needs {len(nodes)} nodes, labs support a "
+                         f"maximum of {MAX_NODES}")
+
+    lab_options = dict(LAB_OPTIONS)
+    lab_options.update(options or {})
+
+    lab = {"lab_options": lab_options, "nodes": {}}
+    for node, (hostname, platform, site) in enumerate(nodes, 1):
+        if site < 1 or site > 254:
+            raise ValueError(f"Site {site} of node \"{hostname}\" must be "
+                             f"between 1 - 254")
+        lab["nodes"][node] = {
+            "hostname": hostname,
+            "platform": platform,
+            "site": site,
+            "neighbors": [],
+        }
+
+    for a, b in links:
+        lab["nodes"][a]["neighbors"].append(b)
+        lab["nodes"][b]["neighbors"].append(a)
+
+    # Ensure every node has an interface for each neighbor
+    for node in lab["nodes"].values():
+        available = interface_count(platforms, node["platform"])
+        if len(node["neighbors"]) > available:
+            raise ValueError(f"Node \"{node['hostname']}\" needs "
+                             f"{len(node['neighbors'])} interfaces, platform "
+                             f"\"{node['platform']}\" only has {available}")
+
+    for node in lab["nodes"].values():
+        node["neighbors"].sort()
+
+    # Anything else wrong with the generated lab is a bug in this module
+    errors, warnings = validate_nodes.validate_lab(lab, platforms)
+    if errors:
+        raise validate_nodes.LabValidationError(errors, warnings)
+
+    return lab
+
+
+def ring(platforms, nodes, platform, options=None):
+    if nodes < 3:
+        raise ValueError("A ring needs at least 3 nodes")
+
+    lab_nodes = [(f"R{node}", platform, 1) for node in range(1, nodes + 1)]
+    links = [(node, node % nodes + 1) for node in range(1, nodes + 1)]
+
+    return build_lab(lab_nodes, links, platforms, options)
+
+
+def mesh(platforms, nodes, platform, options=None):
+    if nodes < 2:
+        raise ValueError("A full mesh needs at least 2 nodes")
+
+    lab_nodes = [(f"R{node}", platform, 1) for node in range(1, nodes + 1)]
+    links = [(a, b) for a in range(1, nodes + 1)
+             for b in range(a + 1, nodes + 1)]
+
+    return build_lab(lab_nodes, links, platforms, options)
+
+
+def leaf_spine(platforms, spines, leaves, platform, spine_platform=None,
+               uplinks=1, options=None):
+    if spines < 1 or leaves < 1 or uplinks < 1:
+        raise ValueError("Leaf-spine needs at least 1 spine, 1 leaf and "
+                         "1 uplink")
+
+    spine_platform = spine_platform or platform
+
+    # Spines are numbered first, then the leaves
+    lab_nodes = [(f"SPINE_{spine}", spine_platform, 1)
+                 for spine in range(1, spines + 1)]
+    lab_nodes += [(f"LEAF_{leaf}", platform, 1)
+                  for leaf in range(1, leaves + 1)]
+
+    links = []
+    for leaf in range(spines + 1, spines + leaves + 1):
+        for spine in range(1, spines + 1):
+            links += [(leaf, spine)] * uplinks
+
+    return build_lab(lab_nodes, links, platforms, options)
+
+
+def sp_core(platforms, sites, p_routers, pe_routers, platform, rrs=2,
+            edge_platform=None, options=None):
+    if sites < 1 or p_routers < 1:
+        raise ValueError("SP core needs at least 1 site and 1 P router")
+    if sites > 254:
+        raise ValueError("SP core supports a maximum of 254 sites")
+
+    edge_platform = edge_platform or platform
+
+    lab_nodes = []
+    links = []
+    site_ps = []  # Node numbers of the P routers of each site
+
+    for site in range(1, sites + 1):
+        ps = []
+        for p in range(1, p_routers + 1):
+            lab_nodes.append((f"P_{site}_{p}", platform, site))
+            ps.append(len(lab_nodes))
+        site_ps.append(ps)
+
+        # Full mesh of the site P routers
+        links += [(a, b) for i, a in enumerate(ps) for b in ps[i + 1:]]
+
+        # PEs and RRs are dual-homed to two P routers of the site
+        for role, count in (("PE", pe_routers), ("RR", rrs)):
+            for index in range(count):
+                lab_nodes.append((f"{role}_{site}_{index + 1}", edge_platform,
+                                  site))
+                homes = {ps[index % len(ps)], ps[(index + 1) % len(ps)]}
+                links += [(len(lab_nodes), p) for p in sorted(homes)]
+
+    # Sites form a ring, P router N of a site connects to P router N of the
+    #  next site (two sites are only connected once)
+    if sites > 1:
+        next_sites = range(sites) if sites > 2 else range(1)
+        for site in next_sites:
+            for a, b in zip(site_ps[site], site_ps[(site + 1) % sites]):
+                links.append((a, b))
+
+    return build_lab(lab_nodes, links, platforms, options)
+
+
+def random_graph(platforms, nodes, links, platform, max_degree=None,
+                 seed=None, options=None):
+    # Random connected graph, no node exceeds max_degree neighbors (and never
+    #  more than the platform interfaces). The same seed gives the same lab.
+    available = interface_count(platforms, platform)
+    max_degree = min(max_degree or available, available)
+
+    if nodes < 2:
+        raise ValueError("A random graph needs at least 2 nodes")
+    if max_degree < 2 and nodes > 2:
+        raise ValueError("A connected random graph needs a maximum degree "
+                         "of at least 2")
+    if links < nodes - 1:
+        raise ValueError(f"A connected graph of {nodes} nodes needs at "
+                         f"least {nodes - 1} links")
+    if links > min(nodes * max_degree // 2, nodes * (nodes - 1) // 2):
+        raise ValueError(f"{links} links do not fit {nodes} nodes with a "
+                         f"maximum of {max_degree} neighbors each")
+
+    rng = random.Random(seed)
+    degree = {node: 0 for node in range(1, nodes + 1)}
+    pairs = set()
+
+    def connect(a, b):
+        pairs.add((min(a, b), max(a, b)))
+        degree[a] += 1
+        degree[b] += 1
+
+    # Random spanning tree first so the graph is connected, every new node
+    #  attaches to a placed node with a free interface
+    order = list(degree)
+    rng.shuffle(order)
+    placed = [order[0]]
+    for node in order[1:]:
+        free = [other for other in placed if degree[other] < max_degree]
+        connect(node, rng.choice(free))
+        placed.append(node)
+
+    # Then random extra links between nodes with free interfaces
+    attempts = 0
+    while len(pairs) < links:
+        free = [node for node in degree if degree[node] < max_degree]
+        a, b = rng.sample(free, 2) if len(free) > 1 else (free[0], free[0])
+        if a != b and (min(a, b), max(a, b)) not in pairs:
+            connect(a, b)
+            attempts = 0
+        else:
+            attempts += 1
+            if attempts > 100 * nodes:
+                raise ValueError(f"Unable to place {links} links, lower the "
+                                 f"number of links or raise max_degree")
+
+    lab_nodes = [(f"R{node}", platform, 1) for node in range(1, nodes + 1)]
+
+    return build_lab(lab_nodes, sorted(pairs), platforms, options)
+
+
+TOPOLOGIES = {
+    "ring": ring,
+    "mesh": mesh,
+    "leaf-spine": leaf_spine,
+    "sp-core": sp_core,
+    "random": random_graph,
+}
+
+
+def generate(topology, platforms, **params):
+    # Generate a lab dict for the named topology (see TOPOLOGIES)
+    if topology not in TOPOLOGIES:
+        raise ValueError(f"Unknown topology \"{topology}\", available: "
+                         f"{', '.join(TOPOLOGIES)}")
+    return TOPOLOGIES[topology](platforms, **params)
+
+
+def format_lab(lab):
+    # Lab YAML in the same layout as the example lab files
+    lines = ["---", "lab_options:"]
+    for option, value in lab["lab_options"].items():
+        lines.append(f"  {option}: {value}")
+
+    lines += ["", "nodes:"]
+    for node, definition in lab["nodes"].items():
+        neighbors = ", ".join(str(n) for n in definition["neighbors"])
+        lines += [f"  {node}:",
+                  f"    hostname: {definition['hostname']}",
+                  f"    platform: {definition['platform']}",
+                  f"    site: {definition['site']}",
+                  f"    neighbors: [{neighbors}]",
+                  ""]
+
+    return "\n".join(lines)
+
+
+def write_lab(lab, yaml_file):
+    with open(yaml_file, "w") as f:
+        f.write(format_lab(lab))
+
+
+def main(options):
+
+    platforms = validate_nodes.validate_platform_defs(options.platforms)
+
+    lab_options = {}
+    if options.lab_name:
+        lab_options["lab_name"] = options.lab_name
+
+    if options.topology == "ring":
+        params = {"nodes": options.nodes, "platform": options.platform}
+    elif options.topology == "mesh":
+        params = {"nodes": options.nodes, "platform": options.platform}
+    elif options.topology == "leaf-spine":
+        params = {"spines": options.spines, "leaves": options.leaves,
+                  "platform": options.platform,
+                  "spine_platform": options.spine_platform,
+                  "uplinks": options.uplinks}
+    elif options.topology == "sp-core":
+        params = {"sites": options.sites, "p_routers": options.p_routers,
+                  "pe_routers": options.pe_routers, "rrs": options.rrs,
+                  "platform": options.platform,
+                  "edge_platform": options.edge_platform}
+    else:
+        params = {"nodes": options.nodes, "links": options.links,
+                  "platform": options.platform,
+                  "max_degree": options.max_degree, "seed": options.seed}
+
+    lab = generate(options.topology, platforms, options=lab_options, **params)
+
+    link_count = sum(len(node["neighbors"])
+                     for node in lab["nodes"].values()) // 2
+
+    if options.file:
+        write_lab(lab, options.file)
+        print(f"{len(lab['nodes'])} nodes and {link_count} links written to "
+              f"\"{options.file}\"")
+    else:
+        print(format_lab(lab))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Generate lab YAML files for "
+                                                 "synthetic topologies")
+
+    parser.add_argument("-f",
+                        "--file",
+                        action="store",
+                        type=str,
+                        help="Write the lab to this file instead of printing "
+                             "it",
+                        metavar="lab.yaml",
+                        dest="file")
+
+    parser.add_argument("-l",
+                        "--lab-name",
+                        action="store",
+                        type=str,
+                        help="Lab name (no spaces)",
+                        dest="lab_name")
+
+    parser.add_argument("--platforms",
+                        action="store",
+                        type=str,
+                        default=NODE_DEFS,
+                        help="Platform definitions YAML file",
+                        metavar="platforms.yaml",
+                        dest="platforms")
+
+    parser.add_argument("-p",
+                        "--platform",
+                        action="store",
+                        type=str,
+                        required=True,
+                        help="Platform of the nodes (leaves and P routers)",
+                        dest="platform")
+
+    topologies = parser.add_subparsers(dest="topology", required=True)
+
+    for name in ("ring", "mesh"):
+        sub = topologies.add_parser(name)
+        sub.add_argument("-n", "--nodes", type=int, required=True,
+                         dest="nodes")
+
+    sub = topologies.add_parser("leaf-spine")
+    sub.add_argument("-s", "--spines", type=int, required=True, dest="spines")
+    sub.add_argument("-L", "--leaves", type=int, required=True, dest="leaves")
+    sub.add_argument("-u", "--uplinks", type=int, default=1, dest="uplinks",
+                     help="Links from each leaf to each spine")
+    sub.add_argument("-sp", "--spine-platform", type=str,
+                     dest="spine_platform",
+                     help="Platform of the spines (default: --platform)")
+
+    sub = topologies.add_parser("sp-core")
+    sub.add_argument("-s", "--sites", type=int, required=True, dest="sites")
+    sub.add_argument("-P", "--p-routers", type=int, default=2,
+                     dest="p_routers", help="P routers per site")
+    sub.add_argument("-e", "--pe-routers", type=int, default=2,
+                     dest="pe_routers", help="PE routers per site")
+    sub.add_argument("-r", "--rrs", type=int, default=2, dest="rrs",
+                     help="Route reflectors per site")
+    sub.add_argument("-ep", "--edge-platform", type=str,
+                     dest="edge_platform",
+                     help="Platform of PEs and RRs (default: --platform)")
+
+    sub = topologies.add_parser("random")
+    sub.add_argument("-n", "--nodes", type=int, required=True, dest="nodes")
+    sub.add_argument("-k", "--links", type=int, required=True, dest="links")
+    sub.add_argument("-d", "--max-degree", type=int, dest="max_degree",
+                     help="Maximum neighbors per node (default: platform "
+                          "interface count)")
+    sub.add_argument("--seed", type=int, dest="seed")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -4,20 +4,76 @@ Author: Jedadiah Casey, @Wax_Trax, neckercube.com
 This module verifies that the nodes defined in the specified YAML files conform
   to the environment constraints. This module is designed to crash with
   specific error messages when certain potentially common mistakes happen.
+
+Lab definitions are validated completely before failing, every violation
+  is collected into a single report (LabValidationError) instead of
+  stopping at the first one.
+
+YAML files are parsed with the libyaml C loader when PyYAML was built with
+  it. Validated definitions are cached on disk (see build_cache.py), keyed
+  on the file path, modification time and content hash, so unchanged files
+  are neither parsed nor validated again.
 """
-from yaml import safe_load
+import hashlib
+import ipaddress
+import json
+import os
+import sys
 
+import yaml
 
-# Validate the platform definitions YAML file
-def validate_platform_defs(yaml_file):
+import address_format
+import build_cache
+import console_drivers
 
-    # Can we load the file?
+# The C loader is many times faster, fall back to pure Python without libyaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+# Read a YAML file, returning its content and the cache key of its
+#  validated definitions (which also depend on any additional inputs)
+def read_definitions(yaml_file, *inputs):
     try:
-        with open(yaml_file) as f:
-            nodes = safe_load(f)
-    except:
+        with open(yaml_file, "rb") as f:
+            content = f.read()
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+    except OSError:
+        raise ValueError(f"Unable to load file \"{yaml_file}\"")
+
+    key = build_cache.digest(os.path.abspath(yaml_file), mtime,
+                             hashlib.sha256(content).hexdigest(),
+                             build_cache.source_digest(sys.modules[__name__]),
+                             *inputs)
+    return content, key
+
+
+def parse_yaml(yaml_file, content):
+    try:
+        return yaml.load(content, Loader=SafeLoader)
+    except yaml.YAMLError:
         raise ValueError(f"Unable to load file \"{yaml_file}\"")
 
+
+# Validate the platform definitions YAML file
+def validate_platform_defs(yaml_file):
+
+    # Can we load the file? The default address formats and console drivers
+    #  are part of the validated platforms
+    content, key = read_definitions(
+        yaml_file, build_cache.source_digest(address_format),
+        build_cache.source_digest(console_drivers))
+
+    # Reuse the validated platforms if the file did not change
+    cache_file = build_cache.definitions_file(yaml_file)
+    nodes = build_cache.load_path(cache_file, key)
+    if nodes is not None:
+        return nodes
+
+    nodes = parse_yaml(yaml_file, content)
+
     for node in nodes:
 
         # Folder tests
@@ -57,202 +113,336 @@ def validate_platform_defs(yaml_file):
             raise ValueError(f"Too many interfaces for platform: \"{node}\" "
                            f"({iface_num} counted, maximum 10)")
 
+        # Clone mode tests, full thin copies unless linked clones requested
+        clone = nodes[node].get("clone") or "thin"
+        if clone not in ("thin", "linked"):
+            raise ValueError(f"Clone mode for platform \"{node}\" must be "
+                             f"\"thin\" or \"linked\"")
+        nodes[node]["clone"] = clone
+
+        # Address format tests, platforms without one keep the format
+        #  selected on the platform name
+        formats = address_format.FORMATS
+        addresses = (nodes[node].get("address_format")
+                     or address_format.default_format(node))
+        if addresses not in formats:
+            raise ValueError(f"Address format for platform \"{node}\" must "
+                             f"be one of: {', '.join(formats)}")
+        nodes[node]["address_format"] = addresses
+
+        # Console driver tests, platforms without one keep the driver of
+        #  the shipped platform with the same name (none for some
+        #  platforms, their configurations cannot be pushed)
+        drivers = console_drivers.DRIVERS
+        if "driver" not in nodes[node] and \
+                node not in console_drivers.DEFAULT_DRIVERS:
+            print(f"No console driver defined for platform: \"{node}\", "
+                  f"its configurations cannot be pushed (driver must be "
+                  f"one of: {', '.join(drivers)})")
+        driver = nodes[node].get("driver",
+                                 console_drivers.default_driver(node))
+        if driver is not None and driver not in drivers:
+            raise ValueError(f"Console driver for platform \"{node}\" must "
+                             f"be one of: {', '.join(drivers)}")
+        nodes[node]["driver"] = driver
+
+    build_cache.store_path(cache_file, key, nodes)
+
     return nodes  # All platforms should be successfully-validated now
 
 
-# Validate the specified lab node YAML file
-def validate_lab_defs(yaml_file, platforms):
+class LabValidationError(ValueError):
+    # Raised with every violation found in the lab, not only the first one
 
-    # Can we load the file?
-    try:
-        with open(yaml_file) as f:
-            lab = safe_load(f)
-    except:
-        raise ValueError(f"Unable to load file \"{yaml_file}\"")
+    def __init__(self, errors, warnings=()):
+        self.errors = list(errors)
+        self.warnings = list(warnings)
+        super().__init__(self.text())
 
-    # Lab name tests
-    try:
-        if not lab["lab_options"]["lab_name"]:
-            raise ValueError(f"Lab option lab_name not defined")
-    except:
-        raise ValueError("Missing or malformed lab option: lab_name")
+    def text(self):
+        lines = [f"{len(self.errors)} error(s) found in lab definitions:"]
+        for error in self.errors:
+            lines.append(f"  - {error['message']}")
+        return "\n".join(lines)
 
-    if " " in lab["lab_options"]["lab_name"]:
-        raise ValueError("Lab option lab_name cannot contain spaces")
+    def report(self):
+        return validation_report(self.errors, self.warnings)
 
-    # ESXi host tests
-    try:
-        if not lab["lab_options"]["term_serv"]:
-            raise ValueError(f"Lab option term_serv not defined")
-    except:
-        raise ValueError("Missing or malformed lab option: term_serv")
 
-    if " " in lab["lab_options"]["term_serv"]:
-        raise ValueError("Lab option term_serv cannot contain spaces")
+def validation_report(errors, warnings):
+    # Structured validation report, suitable for json.dump()
+    return {
+        "valid": not errors,
+        "errors": errors,
+        "warnings": warnings,
+    }
 
-    # ESXi username tests
-    try:
-        if not lab["lab_options"]["esxi_username"]:
-            raise ValueError(f"Lab option esxi_username not defined")
-    except:
-        raise ValueError("Missing or malformed lab option: esxi_username")
 
-    if " " in lab["lab_options"]["esxi_username"]:
-        raise ValueError("Lab option esxi_username cannot contain spaces")
+# Lab options which must be a non-empty string without spaces
+STRING_OPTIONS = ["lab_name", "term_serv", "esxi_username", "datastore",
+                  "vswitch", "pg_base"]
 
-    # Is the base telnet port within the range 20 - 65?
-    try:
-        if not lab["lab_options"]["tport_base"]:
-            raise ValueError(f"Lab option tport_base not defined")
-        tpb = int(lab["lab_options"]["tport_base"])
-        if tpb < 20 or tpb > 65:
-            raise ValueError(f"Lab tport_base must be between 20 - 65. "
-                             f"As configured: \"{tpb}\"")
-    except:
-        raise ValueError(f"Lab tport_base must be between 20 - 65.")
 
-    # ESXi datastore tests
-    try:
-        if not lab["lab_options"]["datastore"]:
-            raise ValueError(f"Lab option datastore not defined")
-    except:
-        raise ValueError("Missing or malformed lab option: datastore")
+# Validate the specified lab node YAML file
+def validate_lab_defs(yaml_file, platforms, report_file=None):
+
+    # Can we load the file? The lab is validated against the platforms too
+    content, key = read_definitions(yaml_file, platforms)
+
+    # Reuse the validated lab if neither file changed, only valid labs are
+    #  stored so there are no errors, but the warnings are displayed again
+    cache_file = build_cache.definitions_file(yaml_file)
+    cached = build_cache.load_path(cache_file, key)
+    if cached is not None:
+        lab, warnings = cached
+        for warning in warnings:
+            print(warning["message"])
+        errors = []
+    else:
+        lab = parse_yaml(yaml_file, content)
+        errors, warnings = validate_lab(lab, platforms)
+
+    # Write the JSON report whether or not the lab is valid
+    if report_file:
+        with open(report_file, "w") as f:
+            json.dump(validation_report(errors, warnings), f, indent=2)
+
+    if errors:
+        raise LabValidationError(errors, warnings)
+
+    if cached is None:
+        build_cache.store_path(cache_file, key, (lab, warnings))
 
-    if " " in lab["lab_options"]["datastore"]:
-        raise ValueError("Lab option datastore cannot contain spaces")
+    return lab
 
-    # ESXi vSwitch tests
-    try:
-        if not lab["lab_options"]["vswitch"]:
-            raise ValueError(f"Lab option vswitch not defined")
-    except:
-        raise ValueError("Missing or malformed lab option: vswitch")
 
-    if " " in lab["lab_options"]["vswitch"]:
-        raise ValueError("Lab option vswitch cannot contain spaces")
+# Pool name: IP version, for the optional ip_pools lab option
+IP_POOLS = {"loopback_ipv4": 4, "loopback_ipv6": 6, "p2p_ipv4": 4,
+            "p2p_ipv6": 6}
+
+
+def validate_ip_pools(pools, error):
+    if not isinstance(pools, dict) or not pools:
+        error(None, "ip_pools", "Lab option ip_pools must define at least "
+                                "one pool")
+        return
+
+    for name, value in pools.items():
+        if name in IP_POOLS:
+            try:
+                network = ipaddress.ip_network(value)
+                if network.version != IP_POOLS[name]:
+                    raise ValueError
+            except (TypeError, ValueError):
+                error(None, "ip_pools", f"IP pool {name} must be an "
+                                        f"IPv{IP_POOLS[name]} network "
+                                        f"(address/prefix), not \"{value}\"")
+        elif name in ("p2p_ipv4_prefix", "p2p_ipv6_prefix"):
+            bits = 32 if name == "p2p_ipv4_prefix" else 128
+            if not isinstance(value, int) or value < 1 or value > bits - 1:
+                error(None, "ip_pools", f"IP pool option {name} must be "
+                                        f"between 1 - {bits - 1}")
+        else:
+            error(None, "ip_pools", f"Unknown IP pool option \"{name}\"")
+
+
+# Validate an already-loaded lab. Every check runs against indexes built in a
+#  single pass over the nodes and neighbors, so the whole lab is validated in
+#  O(nodes + links). All violations are collected and returned as
+#  (errors, warnings), each a list of {"node", "check", "message"} entries.
+def validate_lab(lab, platforms):
+
+    errors = []
+    warnings = []
+
+    def error(node, check, message):
+        errors.append({"node": node, "check": check, "message": message})
+
+    def warning(node, check, message):
+        print(message)
+        warnings.append({"node": node, "check": check, "message": message})
+
+    if not isinstance(lab, dict):
+        error(None, "lab", "Lab file must contain lab_options and nodes")
+        return errors, warnings
+
+    lab_options = lab.get("lab_options")
+    if not isinstance(lab_options, dict):
+        error(None, "lab_options", "Missing or malformed lab_options")
+        lab_options = {}
+
+    # Lab name, ESXi host, username, datastore, vSwitch and base Port Group
+    for option in STRING_OPTIONS:
+        value = lab_options.get(option)
+        if not value or not isinstance(value, str):
+            error(None, option, f"Missing or malformed lab option: {option}")
+        elif " " in value:
+            error(None, option, f"Lab option {option} cannot contain spaces")
 
-    # ESXi base Port Group tests
+    # Is the base telnet port within the range 20 - 65?
     try:
-        if not lab["lab_options"]["pg_base"]:
-            raise ValueError(f"Lab option pg_base not defined")
+        tpb = int(lab_options["tport_base"])
+        if tpb < 20 or tpb > 65:
+            raise ValueError
     except:
-        raise ValueError("Missing or malformed lab option: pg_base")
+        error(None, "tport_base", "Lab tport_base must be between 20 - 65.")
 
-    if " " in lab["lab_options"]["pg_base"]:
-        raise ValueError("Lab option pg_base cannot contain spaces")
+    # Optional number of concurrent clones on the datastore (default 1)
+    if "clone_jobs" in lab_options:
+        try:
+            jobs = int(lab_options["clone_jobs"])
+            if jobs < 1 or jobs > 32:
+                error(None, "clone_jobs",
+                      "Lab option clone_jobs must be between 1 - 32")
+            else:
+                lab_options["clone_jobs"] = jobs
+        except (TypeError, ValueError):
+            error(None, "clone_jobs", "Lab option clone_jobs must be a number")
+
+    # Optional number of nodes configured at the same time (default 64)
+    if "console_jobs" in lab_options:
+        try:
+            jobs = int(lab_options["console_jobs"])
+            if jobs < 1 or jobs > 254:
+                error(None, "console_jobs",
+                      "Lab option console_jobs must be between 1 - 254")
+            else:
+                lab_options["console_jobs"] = jobs
+        except (TypeError, ValueError):
+            error(None, "console_jobs",
+                  "Lab option console_jobs must be a number")
+
+    # Optional IP pools replacing the default addressing (see ip_generate.py)
+    if "ip_pools" in lab_options:
+        validate_ip_pools(lab_options["ip_pools"], error)
+
+    nodes = lab.get("nodes")
+    if not isinstance(nodes, dict) or not nodes:
+        error(None, "nodes", "Missing or malformed lab nodes")
+        return errors, warnings
+
+    # Indexes built in one pass: first node using each hostname, and the
+    #  number of connections from each node to each of its neighbors
+    hostnames = {}
+    links = {}
 
     # Evaluate the individual lab nodes
-    for node in lab["nodes"]:
+    for node, definition in nodes.items():
 
         # Ensure node number is an int between 1 - 254
-        try:
-            if int(node) < 1 or int(node) > 254:
-                raise ValueError(f"All nodes must be defined as a number "
-                                 f"between 1 - 254. Node: \"{node}\"")
-        except:
-            raise ValueError(f"All nodes must be defined as a number "
-                             f"between 1 - 254. Node: \"{node}\"")
+        if not isinstance(node, int) or node < 1 or node > 254:
+            error(node, "node", f"All nodes must be defined as a number "
+                                f"between 1 - 254. Node: \"{node}\"")
 
-        # Hostname tests
-        try:
-            if not lab["nodes"][node]["hostname"]:
-                raise ValueError(f"Hostname not defined for node: \"{node}\"")
-        except:
-            raise ValueError("Missing or malformed hostname for node: "
-                           f"\"{node}\"")
-
-        if " " in lab["nodes"][node]["hostname"]:
-            raise ValueError("Hostname cannot contain spaces for node: "
-                           f"\"{node}\"")
+        if not isinstance(definition, dict):
+            error(node, "node", f"Missing or malformed definition for node: "
+                                f"\"{node}\"")
+            continue
 
+        # Hostname tests
+        hostname = definition.get("hostname")
+        if not hostname or not isinstance(hostname, str):
+            error(node, "hostname", "Missing or malformed hostname for node: "
+                                    f"\"{node}\"")
+        elif " " in hostname:
+            error(node, "hostname", "Hostname cannot contain spaces for node: "
+                                    f"\"{node}\"")
         # Check for duplicate hostnames (duplicates cause issues elsewhere)
-        for node2 in lab["nodes"]:
-            hostname1 = lab["nodes"][node]["hostname"]
-            hostname2 = lab["nodes"][node2]["hostname"]
-            if node != node2:
-                if hostname1 == hostname2:
-                    raise ValueError("Duplicate hostname detected for node "
-                                     f"\"{node}\" and node \"{node2}\"")
+        elif hostname in hostnames:
+            error(node, "hostname", "Duplicate hostname detected for node "
+                                    f"\"{hostnames[hostname]}\" and node "
+                                    f"\"{node}\"")
+        else:
+            hostnames[hostname] = node
 
         # Platform tests
-        try:
-            if not lab["nodes"][node]["platform"]:
-                raise ValueError(f"Platform not specified for node: \"{node}\"")
-        except:
-            raise ValueError("Missing or malformed platform for node: "
-                           f"\"{node}\"")
-
-        if lab["nodes"][node]["platform"] not in platforms:
-            raise ValueError(f"Base platform \""
-                             f"{lab['nodes'][node]['platform']}\" "
-                             f"not in available platform definitions for node: "
-                             f"\"{node}\"")
+        platform = definition.get("platform")
+        if not platform or not isinstance(platform, str):
+            error(node, "platform", "Missing or malformed platform for node: "
+                                    f"\"{node}\"")
+            platform = None
+        elif platform not in platforms:
+            error(node, "platform", f"Base platform \"{platform}\" not in "
+                                    f"available platform definitions for "
+                                    f"node: \"{node}\"")
+            platform = None
 
         # Ensure Site number is an int between 1 - 254
         try:
-            if not lab["nodes"][node]["site"]:
-                raise ValueError(f"Site number (1 - 254) not defined for "
-                                 f"node: \"{node}\"")
-            if int(lab["nodes"][node]["site"]) < 1 or \
-               int(lab["nodes"][node]["site"]) > 254:
-                raise ValueError(f"Sites must be defined as a number "
-                                 f"between 1 - 254. Node: \"{node}\"")
+            site = int(definition["site"])
+            if site < 1 or site > 254:
+                raise ValueError
         except:
-            raise ValueError(f"Sites must be defined as a number "
-                             f"between 1 - 254. Node: \"{node}\"")
-
-        # Determine number of interfaces for platform (for neighbor check)
-        iface_count = 0
-        for iface in platforms[lab["nodes"][node]["platform"]]["interfaces"]:
-            if platforms[lab["nodes"][node]["platform"]]["interfaces"][iface]:
-                iface_count += 1
+            error(node, "site", f"Sites must be defined as a number "
+                                f"between 1 - 254. Node: \"{node}\"")
 
         # Neighbors check
         # Warn if no neighbors but continue because it might be on purpose
-        neighbors_defined = True
-        try:
-            if not lab["nodes"][node]["neighbors"]:
-                print(f"No neighbors defined for node: \"{node}\"")
-                neighbors_defined = False
-        except:
-            print(f"No neighbors defined for node: \"{node}\"")
-            neighbors_defined = False
-
-        if neighbors_defined:
-            # Check if the node has more neighbors than interfaces
-            num_neighbors = len(lab["nodes"][node]["neighbors"])
-            if num_neighbors > iface_count:
-                raise ValueError(f"Node \"{node}\" has {num_neighbors} "
-                                 f"neighbors assigned but only "
-                                 f"{iface_count} total available interfaces")
-
-            for neighbor in lab["nodes"][node]["neighbors"]:
-                # Check if neighbored with self
-                if neighbor is node:
-                    raise ValueError(f"Node cannot be neighbor with "
-                                     f"itself for node: \"{node}\"")
-
-                # Check that all defined neighbors exist
-                if neighbor not in lab["nodes"]:
-                    raise ValueError(f"Neighbor \"{neighbor}\" does not exist "
-                                     f"in lab for node: \"{node}\"")
-
-                # Check for reciprocal connection in neighbor
-                if node not in lab["nodes"][neighbor]["neighbors"]:
-                    raise ValueError(f"Node: \"{node}\" has neighbor "
-                                     f"\"{neighbor}\" defined, but the "
-                                     f"neighbor \"{neighbor}\" does not have "
-                                     f"\"{node}\" listed as one of its "
-                                     f"neighbors")
-
-                # Check for reciprocal multi-connections in neighbor
-                xcount = lab["nodes"][node]["neighbors"].count(neighbor)
-                ycount = lab["nodes"][neighbor]["neighbors"].count(node)
-                if xcount != ycount:
-                    raise ValueError(f"Node \"{node}\" has \"{xcount}\" "
-                                     f"connection(s) to neighbor \"{neighbor}\""
-                                     f" defined, but \"{neighbor}\" has "
-                                     f"\"{ycount}\" connction(s) defined. "
-                                     f"These values must match.")
-
-    return lab
+        neighbors = definition.get("neighbors")
+        if not neighbors:
+            warning(node, "neighbors",
+                    f"No neighbors defined for node: \"{node}\"")
+            links[node] = {}
+            continue
+
+        if not isinstance(neighbors, list):
+            error(node, "neighbors", f"Neighbors must be a list (in brackets) "
+                                     f"for node: \"{node}\"")
+            continue
+
+        # Check if the node has more neighbors than interfaces
+        if platform:
+            iface_count = sum(1 for iface in
+                              platforms[platform]["interfaces"].values()
+                              if iface)
+            if len(neighbors) > iface_count:
+                error(node, "neighbors", f"Node \"{node}\" has "
+                                         f"{len(neighbors)} neighbors "
+                                         f"assigned but only {iface_count} "
+                                         f"total available interfaces")
+
+        counts = {}
+        for neighbor in neighbors:
+            counts[neighbor] = counts.get(neighbor, 0) + 1
+        links[node] = counts
+
+    # Neighbor checks, each distinct (node, neighbor) pair is visited once
+    for node, counts in links.items():
+        for neighbor, xcount in counts.items():
+
+            # Check if neighbored with self
+            if neighbor == node:
+                error(node, "neighbors", f"Node cannot be neighbor with "
+                                         f"itself for node: \"{node}\"")
+                continue
+
+            # Check that all defined neighbors exist
+            if neighbor not in nodes:
+                error(node, "neighbors", f"Neighbor \"{neighbor}\" does not "
+                                         f"exist in lab for node: \"{node}\"")
+                continue
+
+            if neighbor not in links:
+                continue  # Malformed neighbor already reported
+
+            # Check for reciprocal (multi-)connections in neighbor. The pair
+            #  is reported once, from the node with more connections.
+            ycount = links[neighbor].get(node, 0)
+            if xcount <= ycount:
+                continue
+
+            if ycount == 0:
+                error(node, "neighbors", f"Node: \"{node}\" has neighbor "
+                                         f"\"{neighbor}\" defined, but the "
+                                         f"neighbor \"{neighbor}\" does not "
+                                         f"have \"{node}\" listed as one of "
+                                         f"its neighbors")
+            else:
+                error(node, "neighbors", f"Node \"{node}\" has \"{xcount}\" "
+                                         f"connection(s) to neighbor "
+                                         f"\"{neighbor}\" defined, but "
+                                         f"\"{neighbor}\" has \"{ycount}\" "
+                                         f"connection(s) defined. These "
+                                         f"values must match.")
+
+    return errors, warnings